@@ -3,13 +3,22 @@
 import asyncio
 import hashlib
 import inspect
+import json
 import logging
 import math
+import multiprocessing
 import os
+import queue
+import sqlite3
+import threading
+import time
 from collections import defaultdict
-from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, BinaryIO
+from types import SimpleNamespace
+from typing import (Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, BinaryIO, Iterator,
+                    AsyncIterator, Set, Dict, Callable, AsyncIterable, NamedTuple, Any)
 
 from telethon import utils, helpers, TelegramClient
+from telethon.errors import FloodError, ServerError, TimedOutError
 from telethon.crypto import AuthKey
 from telethon.network import MTProtoSender
 from telethon.tl.alltlobjects import LAYER
@@ -31,28 +40,24 @@ log: logging.Logger = logging.getLogger("telethon")
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
+# Errors after which sending the same part again can succeed
+RETRYABLE_ERRORS = (FloodError, ServerError, TimedOutError, OSError, asyncio.TimeoutError)
+
 
 class DownloadSender:
     client: TelegramClient
     sender: MTProtoSender
-    request: GetFileRequest
-    remaining: int
-    stride: int
+    file: TypeLocation
+    reconnecting: asyncio.Lock
 
-    def __init__(self, client: TelegramClient, sender: MTProtoSender, file: TypeLocation, offset: int, limit: int,
-                 stride: int, count: int) -> None:
+    def __init__(self, client: TelegramClient, sender: MTProtoSender, file: TypeLocation) -> None:
         self.sender = sender
         self.client = client
-        self.request = GetFileRequest(file, offset=offset, limit=limit)
-        self.stride = stride
-        self.remaining = count
+        self.file = file
+        self.reconnecting = asyncio.Lock()
 
-    async def next(self) -> Optional[bytes]:
-        if not self.remaining:
-            return None
-        result = await self.client._call(self.sender, self.request)
-        self.remaining -= 1
-        self.request.offset += self.stride
+    async def fetch(self, offset: int, limit: int) -> bytes:
+        result = await self.client._call(self.sender, GetFileRequest(self.file, offset=offset, limit=limit))
         return result.bytes
 
     def disconnect(self) -> Awaitable[None]:
@@ -62,64 +67,450 @@ class DownloadSender:
 class UploadSender:
     client: TelegramClient
     sender: MTProtoSender
-    request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
+    file_id: int
     part_count: int
-    stride: int
-    previous: Optional[asyncio.Task]
+    big: bool
+    depth: int
+    in_flight: Set[asyncio.Task]
+    errors: List[BaseException]
     loop: asyncio.AbstractEventLoop
+    on_sent: Optional[Callable[[int, int, float], None]]
+    on_error: Optional[Callable[["UploadSender", int, bytes, BaseException], Awaitable[None]]]
 
     def __init__(self, client: TelegramClient, sender: MTProtoSender, file_id: int, part_count: int, big: bool,
-                 index: int,
-                 stride: int, loop: asyncio.AbstractEventLoop) -> None:
+                 loop: asyncio.AbstractEventLoop, depth: int = 1,
+                 on_sent: Optional[Callable[[int, int, float], None]] = None,
+                 on_error: Optional[Callable[["UploadSender", int, bytes, BaseException], Awaitable[None]]] = None
+                 ) -> None:
         self.client = client
         self.sender = sender
+        self.file_id = file_id
         self.part_count = part_count
-        if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
-        else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
-        self.stride = stride
-        self.previous = None
+        self.big = big
+        self.depth = depth
+        self.in_flight = set()
+        self.errors = []
         self.loop = loop
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.reconnecting = asyncio.Lock()
+
+    def _request(self, part: int, data: bytes) -> Union[SaveFilePartRequest, SaveBigFilePartRequest]:
+        if self.big:
+            return SaveBigFilePartRequest(self.file_id, part, self.part_count, data)
+        return SaveFilePartRequest(self.file_id, part, data)
+
+    async def next(self, part: int, data: Union[bytes, memoryview]) -> None:
+        # Parts may be views into a reused read buffer, so take the one copy the TL serializer needs
+        # before yielding to the loop.
+        data = bytes(data)
+        while len(self.in_flight) >= self.depth:
+            await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+        self._raise_errors()
+        task = self.loop.create_task(self._next(part, data))
+        task.add_done_callback(self._finished)
+        self.in_flight.add(task)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        # Finished requests leave in_flight right away so it always counts the requests on the wire
+        self.in_flight.discard(task)
+        if not task.cancelled() and task.exception():
+            self.errors.append(task.exception())
 
-    async def next(self, data: bytes) -> None:
-        if self.previous:
-            await self.previous
-        self.previous = self.loop.create_task(self._next(data))
+    def _raise_errors(self) -> None:
+        if self.errors:
+            raise self.errors.pop(0)
 
-    async def _next(self, data: bytes) -> None:
-        self.request.bytes = data
-        log.debug(f"Sending file part {self.request.file_part}/{self.part_count}"
+    async def _next(self, part: int, data: bytes) -> None:
+        try:
+            await self.send(part, data)
+        except RETRYABLE_ERRORS as e:
+            if not self.on_error:
+                raise
+            await self.on_error(self, part, data, e)
+
+    async def send(self, part: int, data: bytes) -> None:
+        log.debug(f"Sending file part {part}/{self.part_count}"
                   f" with {len(data)} bytes")
-        await self.client._call(self.sender, self.request)
-        self.request.file_part += self.stride
+        start = time.monotonic()
+        await self.client._call(self.sender, self._request(part, data))
+        if self.on_sent:
+            self.on_sent(part, len(data), time.monotonic() - start)
+
+    async def wait(self) -> None:
+        await asyncio.gather(*self.in_flight, return_exceptions=True)
+        self._raise_errors()
 
     async def disconnect(self) -> None:
-        if self.previous:
-            await self.previous
+        await self.wait()
         return await self.sender.disconnect()
 
 
+# Caps the connections all transfers of the process hold, in total and per DC, because Telegram
+# drops connections past its limits. A transfer asks for its senders when it starts. Waiting
+# transfers are served smallest file first, and none gets more than an even share of the budget
+# while others wait. Transfers that tune their connection count grow one sender at a time while
+# there is room, and hand senders back once they hold more than their share and others wait.
+class ConnectionBudget:
+    total: int
+    per_dc: int
+    used: DefaultDict[int, int]
+    used_total: int
+    transfers: int
+    waiters: List[Tuple[float, int, int, int, asyncio.Future]]
+
+    def __init__(self, total: int = 20, per_dc: Optional[int] = None) -> None:
+        self.total = max(1, total)
+        self.per_dc = max(1, per_dc or total)
+        self.used = defaultdict(int)
+        self.used_total = 0
+        self.transfers = 0
+        self.waiters = []
+        self.sequence = 0
+
+    def free(self, dc_id: int) -> int:
+        return min(self.total - self.used_total, self.per_dc - self.used[dc_id])
+
+    def fair_share(self) -> int:
+        return max(1, self.total // max(1, self.transfers + len(self.waiters)))
+
+    def _take(self, dc_id: int, count: int) -> None:
+        self.used[dc_id] += count
+        self.used_total += count
+
+    def _wake(self) -> None:
+        for waiter in sorted(self.waiters):
+            if self.used_total >= self.total:
+                return
+            _, _, dc_id, wanted, future = waiter
+            if self.free(dc_id) <= 0:
+                continue
+            self.waiters.remove(waiter)
+            self.transfers += 1
+            granted = min(wanted, self.free(dc_id), self.fair_share())
+            self._take(dc_id, granted)
+            future.set_result(granted)
+
+    async def acquire(self, dc_id: int, wanted: int, size: float = math.inf) -> int:
+        # Returns the number of senders granted, at least one and at most `wanted`
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        waiter = (size, self.sequence, dc_id, max(1, wanted), future)
+        self.waiters.append(waiter)
+        self._wake()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(dc_id, future.result(), finished=True)
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+
+    def grow(self, dc_id: int, held: int) -> bool:
+        if self.free(dc_id) <= 0 or (self.waiters and held >= self.fair_share()):
+            return False
+        self._take(dc_id, 1)
+        return True
+
+    def should_yield(self, held: int) -> bool:
+        return bool(self.waiters) and held > self.fair_share()
+
+    def release(self, dc_id: int, count: int, finished: bool = False) -> None:
+        self._take(dc_id, -count)
+        if finished:
+            self.transfers -= 1
+        self._wake()
+
+
+# Keeps connected MTProtoSenders per DC alive between transfers, together with the authorization
+# exported to foreign DCs, so consecutive files don't pay the connection and auth handshake again.
+# Transfers using the pool also share its connection budget, if it has one.
+class SenderPool:
+    client: TelegramClient
+    idle: DefaultDict[int, List[Tuple[MTProtoSender, float]]]
+    auth_keys: Dict[int, AuthKey]
+    auth_locks: DefaultDict[int, asyncio.Lock]
+    idle_timeout: float
+    max_idle: int
+    budget: Optional[ConnectionBudget]
+
+    def __init__(self, client: TelegramClient, idle_timeout: float = 300, max_idle: int = 20,
+                 budget: Optional[ConnectionBudget] = None) -> None:
+        self.client = client
+        self.idle = defaultdict(list)
+        self.auth_keys = {}
+        self.auth_locks = defaultdict(asyncio.Lock)
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.budget = budget
+
+    def _get_auth_key(self, dc_id: int) -> Optional[AuthKey]:
+        if dc_id == self.client.session.dc_id:
+            return self.client.session.auth_key
+        return self.auth_keys.get(dc_id)
+
+    async def _connect(self, dc_id: int, auth_key: Optional[AuthKey]) -> MTProtoSender:
+        dc = await self.client._get_dc(dc_id)
+        sender = MTProtoSender(auth_key, loggers=self.client._log)
+        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
+                                                     loggers=self.client._log,
+                                                     proxy=self.client._proxy))
+        return sender
+
+    async def _create(self, dc_id: int) -> MTProtoSender:
+        auth_key = self._get_auth_key(dc_id)
+        if auth_key:
+            return await self._connect(dc_id, auth_key)
+        # Only the first sender to a foreign DC exports the authorization, the rest reuse its key.
+        async with self.auth_locks[dc_id]:
+            auth_key = self._get_auth_key(dc_id)
+            if auth_key:
+                return await self._connect(dc_id, auth_key)
+            sender = await self._connect(dc_id, None)
+            log.debug(f"Exporting auth to DC {dc_id}")
+            auth = await self.client(ExportAuthorizationRequest(dc_id))
+            self.client._init_request.query = ImportAuthorizationRequest(id=auth.id,
+                                                                         bytes=auth.bytes)
+            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
+            await sender.send(req)
+            self.auth_keys[dc_id] = sender.auth_key
+            return sender
+
+    async def _evict(self) -> None:
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        for dc_id, idle in self.idle.items():
+            expired += [sender for sender, released in idle if released < deadline]
+            idle[:] = [(sender, released) for sender, released in idle if released >= deadline]
+        if expired:
+            log.debug(f"Closing {len(expired)} idle senders")
+            await asyncio.gather(*[sender.disconnect() for sender in expired])
+
+    async def acquire(self, dc_id: int) -> MTProtoSender:
+        await self._evict()
+        idle = self.idle[dc_id]
+        while idle:
+            sender, _ = idle.pop()
+            # A sender whose reconnect attempts gave up is no longer usable
+            if sender.is_connected():
+                return sender
+            await sender.disconnect()
+        return await self._create(dc_id)
+
+    async def release(self, dc_id: int, sender: MTProtoSender) -> None:
+        idle = self.idle[dc_id]
+        if not sender.is_connected() or len(idle) >= self.max_idle:
+            await sender.disconnect()
+        else:
+            idle.append((sender, time.monotonic()))
+        await self._evict()
+
+    async def close(self) -> None:
+        senders = [sender for idle in self.idle.values() for sender, _ in idle]
+        self.idle.clear()
+        await asyncio.gather(*[sender.disconnect() for sender in senders])
+
+
+# Remembers the connection count and part size that worked best per DC, so the next transfer
+# starts close to them instead of ramping up from the static defaults again.
+class TransferTuning:
+    path: Optional[str]
+    state: Dict[str, Dict[str, float]]
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.state = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as file:
+                    self.state = json.load(file)
+            except (OSError, ValueError) as e:
+                log.warning(f"Ignoring unreadable transfer tuning {path}: {e}")
+
+    def get(self, dc_id: int) -> Dict[str, float]:
+        return self.state.get(str(dc_id), {})
+
+    def update(self, dc_id: int, connections: int, part_size_kb: int, latency: float,
+               latency_part_size_kb: int) -> None:
+        self.state[str(dc_id)] = {"connections": connections, "part_size_kb": part_size_kb,
+                                  "latency": latency, "latency_part_size_kb": latency_part_size_kb}
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.state, file)
+        os.replace(tmp_path, self.path)
+
+
+# AIMD over the number of senders a transfer keeps busy. After every window of parts the goodput
+# and mean part latency are compared with the previous window: while latency stays near the
+# lowest window mean seen one more sender is added, once requests queue up without any goodput gain
+# (or a flood wait was hit) the number of senders is cut by `decrease`. Without a baseline latency
+# for the part size, the transfer starts from one sender and doubles until the first queueing, so
+# the baseline is measured on an idle link. The part size can't change in the middle of a file, so
+# it is only adjusted for the next transfer.
+class AdaptiveController:
+    tuning: TransferTuning
+    dc_id: int
+    active: int
+    max_active: int
+    part_size_kb: int
+    depth: int
+
+    def __init__(self, tuning: TransferTuning, dc_id: int, connections: int, max_active: int,
+                 part_size_kb: int, depth: int = 1, decrease: float = 0.7, latency_slack: float = 0.25,
+                 max_part_size_kb: int = 512, fixed_part_size: bool = False) -> None:
+        saved = tuning.get(dc_id)
+        self.tuning = tuning
+        self.dc_id = dc_id
+        self.max_active = max(1, max_active)
+        self.active = max(1, min(saved.get("connections", connections), self.max_active))
+        self.min_part_size_kb = part_size_kb
+        self.max_part_size_kb = max_part_size_kb
+        self.part_size_kb = (part_size_kb if fixed_part_size
+                             else max(part_size_kb, min(saved.get("part_size_kb", 0), max_part_size_kb)))
+        self.depth = depth
+        self.decrease = decrease
+        self.latency_slack = latency_slack
+        # The uncongested latency of the last run is only comparable with the same part size
+        self.min_latency = (saved.get("latency", math.inf)
+                            if saved.get("latency_part_size_kb") == self.part_size_kb else math.inf)
+        self.slow_start = math.isinf(self.min_latency)
+        if self.slow_start:
+            self.active = 1
+        self.goodput = math.inf
+        self.mean_latency = 0.0
+        self.windows = 0
+        self.active_total = 0
+        self.flooded = False
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_parts = 0
+
+    def record(self, size: int, latency: float) -> None:
+        self.window_bytes += size
+        self.window_latency += latency
+        self.window_parts += 1
+        # A window spans two rounds of every active sender's pipeline
+        if self.window_parts >= 2 * self.active * self.depth:
+            self._adjust()
+
+    def congestion(self) -> None:
+        self.flooded = True
+        self.slow_start = False
+        self.active = max(1, int(self.active * self.decrease))
+
+    def _adjust(self) -> None:
+        goodput = self.window_bytes / max(time.monotonic() - self.window_start, 1e-6)
+        mean_latency = self.window_latency / self.window_parts
+        self.min_latency = min(self.min_latency, mean_latency)
+        queueing = mean_latency > self.min_latency * (1 + self.latency_slack)
+        if queueing and goodput <= self.goodput * 1.05:
+            self.active = max(1, int(self.active * self.decrease))
+            self.slow_start = False
+        elif self.slow_start:
+            self.active = min(self.max_active, self.active * 2)
+        elif self.active < self.max_active:
+            self.active += 1
+        log.debug(f"Adaptive transfer to DC {self.dc_id}: {goodput / 1024 / 1024:.2f} MiB/s,"
+                  f" {mean_latency:.3f}s per part, {self.active} senders")
+        self.goodput = goodput
+        self.mean_latency = mean_latency
+        self.windows += 1
+        self.active_total += self.active
+        self._reset_window()
+
+    def finish(self) -> None:
+        if not self.windows:
+            return
+        part_size_kb = self.part_size_kb
+        if self.flooded or self.mean_latency > 2:
+            part_size_kb = max(self.min_part_size_kb, part_size_kb // 2)
+        elif self.min_latency < 0.5:
+            # Parts that are acknowledged quickly are dominated by per-request overhead
+            part_size_kb = min(self.max_part_size_kb, part_size_kb * 2)
+        # The next run starts from the middle of the AIMD sawtooth rather than wherever this one
+        # stopped, and the baseline drifts up a little so one unusually fast run doesn't pin it forever.
+        self.tuning.update(self.dc_id, round(self.active_total / self.windows), part_size_kb,
+                           self.min_latency * 1.02, self.part_size_kb)
+
+
 class ParallelTransferrer:
     client: TelegramClient
     loop: asyncio.AbstractEventLoop
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
     auth_key: AuthKey
-    upload_ticker: int
+    pool: Optional[SenderPool]
+    budget: Optional[ConnectionBudget]
+    granted: int
+    reserved: bool
+    controller: Optional[AdaptiveController]
+    next_part: int
+    part_retries: int
+    on_part_sent: Optional[Callable[[int], None]]
 
-    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
+    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None, pool: Optional[SenderPool] = None,
+                 part_retries: int = 5, on_part_sent: Optional[Callable[[int], None]] = None) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
         self.auth_key = (None if dc_id and self.client.session.dc_id != dc_id
                          else self.client.session.auth_key)
+        self.pool = pool
+        self.budget = pool.budget if pool else None
+        self.granted = 0
+        self.reserved = False
+        self.controller = None
         self.senders = None
-        self.upload_ticker = 0
+        self.next_part = 0
+        self.part_retries = part_retries
+        self.on_part_sent = on_part_sent
 
     async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
-        self.senders = None
+        if not self.pool:
+            await asyncio.gather(*[sender.disconnect() for sender in self.senders])
+            self.senders = None
+            return
+        senders, self.senders = self.senders, None
+        try:
+            await asyncio.gather(*[sender.wait() for sender in senders if isinstance(sender, UploadSender)])
+        except BaseException:
+            # Don't hand connections with failed requests back to the pool
+            await asyncio.gather(*[sender.sender.disconnect() for sender in senders])
+            raise
+        else:
+            for sender in senders:
+                await self.pool.release(self.dc_id, sender.sender)
+        finally:
+            # Connections are back in the pool before the next transfer is let in
+            self._release_budget()
+
+    async def _reserve(self, wanted: int, file_size: float) -> int:
+        if not self.budget:
+            return wanted
+        self.granted = await self.budget.acquire(self.dc_id, wanted, file_size)
+        self.reserved = True
+        if self.granted < wanted:
+            log.debug(f"Connection budget granted {self.granted} of {wanted} senders to DC {self.dc_id}")
+        return self.granted
+
+    def _release_budget(self) -> None:
+        if self.reserved:
+            self.budget.release(self.dc_id, self.granted, finished=True)
+            self.granted = 0
+            self.reserved = False
+
+    async def _give_back(self, sender: Union[DownloadSender, UploadSender]) -> None:
+        self.senders.remove(sender)
+        await self.pool.release(self.dc_id, sender.sender)
+        self.granted -= 1
+        self.budget.release(self.dc_id, 1)
 
     @staticmethod
     def _get_connection_count(file_size: int, max_count: int = 20,
@@ -128,49 +519,96 @@ class ParallelTransferrer:
             return max_count
         return math.ceil((file_size / full_size) * max_count)
 
-    async def _init_download(self, connections: int, file: TypeLocation, part_count: int,
-                             part_size: int) -> None:
-        minimum, remainder = divmod(part_count, connections)
-
-        def get_part_count() -> int:
-            nonlocal remainder
-            if remainder > 0:
-                remainder -= 1
-                return minimum + 1
-            return minimum
-
+    async def _init_download(self, connections: int, file: TypeLocation) -> None:
         # The first cross-DC sender will export+import the authorization, so we always create it
         # before creating any other senders.
         self.senders = [
-            await self._create_download_sender(file, 0, part_size, connections * part_size,
-                                               get_part_count()),
-            *await asyncio.gather(
-                *[self._create_download_sender(file, i, part_size, connections * part_size,
-                                               get_part_count())
-                  for i in range(1, connections)])
+            await self._create_download_sender(file),
+            *await asyncio.gather(*[self._create_download_sender(file) for _ in range(1, connections)])
         ]
 
-    async def _create_download_sender(self, file: TypeLocation, index: int, part_size: int,
-                                      stride: int,
-                                      part_count: int) -> DownloadSender:
-        return DownloadSender(self.client, await self._create_sender(), file, index * part_size, part_size,
-                              stride, part_count)
+    async def _create_download_sender(self, file: TypeLocation) -> DownloadSender:
+        return DownloadSender(self.client, await self._create_sender(), file)
 
-    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool
+    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool, depth: int
                            ) -> None:
+        self.upload_args = (file_id, part_count, big, depth)
         self.senders = [
-            await self._create_upload_sender(file_id, part_count, big, 0, connections),
+            await self._create_upload_sender(file_id, part_count, big, depth),
             *await asyncio.gather(
-                *[self._create_upload_sender(file_id, part_count, big, i, connections)
-                  for i in range(1, connections)])
+                *[self._create_upload_sender(file_id, part_count, big, depth)
+                  for _ in range(1, connections)])
         ]
 
-    async def _create_upload_sender(self, file_id: int, part_count: int, big: bool, index: int,
-                                    stride: int) -> UploadSender:
-        return UploadSender(self.client, await self._create_sender(), file_id, part_count, big, index, stride,
-                            loop=self.loop)
+    async def _create_upload_sender(self, file_id: int, part_count: int, big: bool, depth: int
+                                    ) -> UploadSender:
+        return UploadSender(self.client, await self._create_sender(), file_id, part_count, big,
+                            loop=self.loop, depth=depth, on_sent=self._on_part_sent,
+                            on_error=self._retry_part)
+
+    def _on_part_sent(self, part: int, size: int, latency: float) -> None:
+        if self.controller:
+            self.controller.record(size, latency)
+        if self.on_part_sent:
+            self.on_part_sent(part)
+
+    async def _replace_connection(self, sender: Union[DownloadSender, UploadSender], broken: MTProtoSender
+                                  ) -> None:
+        # Several parts in flight on the same connection fail together, only the first one reconnects
+        async with sender.reconnecting:
+            if sender.sender is not broken:
+                return
+            log.info(f"Replacing dropped connection to DC {self.dc_id}")
+            sender.sender = await self._create_sender()
+        try:
+            await broken.disconnect()
+        except Exception as e:
+            log.debug(f"Error disconnecting dropped connection: {e}")
+
+    async def _retry_part(self, sender: UploadSender, part: int, data: bytes, error: BaseException) -> None:
+        for attempt in range(1, self.part_retries + 1):
+            # Only FloodWaitError and friends carry a wait time; other flood errors fall back to
+            # the backoff below.
+            seconds = getattr(error, 'seconds', None)
+            if isinstance(error, FloodError) and self.controller:
+                self.controller.congestion()
+            if seconds is not None:
+                log.info(f"Flood wait of {seconds}s while sending part {part}")
+                await asyncio.sleep(seconds)
+            else:
+                log.info(f"Sending part {part} failed ({error!r}), retry {attempt}/{self.part_retries}")
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 30))
+                if isinstance(error, OSError) or not sender.sender.is_connected():
+                    await self._replace_connection(sender, sender.sender)
+            # Requeue the part on whichever healthy sender is least busy, which may be the same one
+            # once its connection was replaced.
+            target = min(self.senders or [sender], key=lambda s: len(s.in_flight))
+            try:
+                await target.send(part, data)
+                return
+            except RETRYABLE_ERRORS as e:
+                sender, error = target, e
+        raise error
+
+    async def _fetch_part(self, sender: DownloadSender, offset: int, limit: int) -> bytes:
+        for attempt in range(1, self.part_retries + 1):
+            try:
+                return await sender.fetch(offset, limit)
+            except RETRYABLE_ERRORS as e:
+                seconds = getattr(e, 'seconds', None)
+                if seconds is not None:
+                    log.info(f"Flood wait of {seconds}s while fetching offset {offset}")
+                    await asyncio.sleep(seconds)
+                else:
+                    log.info(f"Fetching offset {offset} failed ({e!r}), retry {attempt}/{self.part_retries}")
+                    await asyncio.sleep(min(0.5 * 2 ** attempt, 30))
+                    if isinstance(e, OSError) or not sender.sender.is_connected():
+                        await self._replace_connection(sender, sender.sender)
+        return await sender.fetch(offset, limit)
 
     async def _create_sender(self) -> MTProtoSender:
+        if self.pool:
+            return await self.pool.acquire(self.dc_id)
         dc = await self.client._get_dc(self.dc_id)
         sender = MTProtoSender(self.auth_key, loggers=self.client._log)
         await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
@@ -187,49 +625,199 @@ class ParallelTransferrer:
         return sender
 
     async def init_upload(self, file_id: int, file_size: int, part_size_kb: Optional[float] = None,
-                          connection_count: Optional[int] = None) -> Tuple[int, int, bool]:
-        connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+                          connection_count: Optional[int] = None, pipeline_depth: int = 4,
+                          tuning: Optional[TransferTuning] = None) -> Tuple[int, int, bool]:
+        # Every connection keeps pipeline_depth parts in flight, so fewer connections are needed
+        # to reach the same number of outstanding requests.
+        connection_count = connection_count or math.ceil(self._get_connection_count(file_size)
+                                                         / pipeline_depth)
+        part_size_fixed = part_size_kb is not None
+        part_size_kb = part_size_kb or utils.get_appropriated_part_size(file_size)
+        if tuning:
+            self.controller = AdaptiveController(tuning, self.dc_id, connection_count,
+                                                 self._get_connection_count(file_size),
+                                                 part_size_kb, depth=pipeline_depth,
+                                                 fixed_part_size=part_size_fixed)
+            connection_count = self.controller.active
+            part_size_kb = self.controller.part_size_kb
+        part_size = int(part_size_kb * 1024)
         part_count = (file_size + part_size - 1) // part_size
         is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+        self.next_part = 0
+        connection_count = await self._reserve(connection_count, file_size)
+        try:
+            await self._init_upload(connection_count, file_id, part_count, is_large, pipeline_depth)
+        except BaseException:
+            await self.abort()
+            raise
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
-        self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
+    async def init_stream_upload(self, file_id: int, part_size_kb: int = 512,
+                                 connection_count: Optional[int] = None, pipeline_depth: int = 4,
+                                 tuning: Optional[TransferTuning] = None) -> int:
+        # The part count of a streamed upload is only known once the stream ends. Until then every
+        # part is sent with file_total_parts = -1, see set_part_count. The size is unknown as well,
+        # so the stream is sized like a big file.
+        connection_count = connection_count or math.ceil(self._get_connection_count(math.inf) / pipeline_depth)
+        if tuning:
+            self.controller = AdaptiveController(tuning, self.dc_id, connection_count,
+                                                 self._get_connection_count(math.inf), part_size_kb,
+                                                 depth=pipeline_depth, fixed_part_size=True)
+            connection_count = self.controller.active
+        self.next_part = 0
+        connection_count = await self._reserve(connection_count, math.inf)
+        try:
+            await self._init_upload(connection_count, file_id, -1, True, pipeline_depth)
+        except BaseException:
+            await self.abort()
+            raise
+        return part_size_kb * 1024
+
+    def set_part_count(self, part_count: int) -> None:
+        file_id, _, big, depth = self.upload_args
+        self.upload_args = (file_id, part_count, big, depth)
+        for sender in self.senders:
+            sender.part_count = part_count
+
+    async def _get_upload_senders(self) -> List[UploadSender]:
+        if not self.controller:
+            return self.senders
+        if self.budget:
+            # Idle senders past the fair share, or past what the controller uses, are handed back
+            # while other transfers wait for a connection
+            while (len(self.senders) > 1 and self.budget.waiters
+                   and (self.budget.should_yield(len(self.senders)) or len(self.senders) > self.controller.active)
+                   and not self.senders[-1].in_flight and not self.senders[-1].errors):
+                await self._give_back(self.senders[-1])
+        # Connections are opened lazily as the controller grows and left idle when it shrinks
+        while len(self.senders) < self.controller.active:
+            if self.budget:
+                if not self.budget.grow(self.dc_id, len(self.senders)):
+                    break
+                self.granted += 1
+            self.senders.append(await self._create_upload_sender(*self.upload_args))
+        return self.senders[:self.controller.active]
+
+    async def upload(self, part: Union[bytes, memoryview], index: Optional[int] = None) -> None:
+        # Parts are numbered in call order unless the caller skips some, e.g. when resuming
+        if index is not None:
+            self.next_part = index
+        sender = min(await self._get_upload_senders(), key=lambda s: len(s.in_flight))
+        await sender.next(self.next_part, part)
+        self.next_part += 1
 
     async def finish_upload(self) -> None:
         await self._cleanup()
+        if self.controller:
+            self.controller.finish()
 
-    async def download(self, file: TypeLocation, file_size: int,
-                       part_size_kb: Optional[float] = None,
-                       connection_count: Optional[int] = None) -> AsyncGenerator[bytes, None]:
+    async def abort(self) -> None:
+        self._release_budget()
+        if not self.senders:
+            return
+        senders, self.senders = self.senders, None
+        for sender in senders:
+            for task in getattr(sender, "in_flight", ()):
+                task.cancel()
+        # Connections of a failed transfer may be broken, so they are closed instead of pooled
+        await asyncio.gather(*[sender.sender.disconnect() for sender in senders], return_exceptions=True)
+
+    async def download_parts(self, file: TypeLocation, file_size: int,
+                             part_size_kb: Optional[float] = None,
+                             connection_count: Optional[int] = None,
+                             ordered: bool = False,
+                             window: Optional[int] = None,
+                             skip: Optional[Set[int]] = None) -> AsyncGenerator[Tuple[int, bytes], None]:
+        # Every sender fetches the next missing part as soon as it is free, so a slow connection only
+        # delays its own part instead of a whole round. Parts are yielded as (offset, data) as they
+        # arrive, or in file order with ordered=True. Senders then stay at most `window` parts ahead
+        # of the consumer, which bounds the parts held back for reordering. Either way at most one
+        # part per sender waits for a slow consumer. Parts in `skip` are neither fetched nor yielded.
         connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        part_size = int((part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024)
         part_count = math.ceil(file_size / part_size)
+        skip = skip or set()
+        if ordered and skip:
+            raise ValueError("Skipping parts needs unordered parts")
+        wanted = part_count - len(skip & set(range(part_count)))
+        if not wanted:
+            return
+        connection_count = max(1, min(connection_count, wanted))
+        window = window or 2 * connection_count
         log.debug("Starting parallel download: "
                   f"{connection_count} {part_size} {part_count} {file!s}")
-        await self._init_download(connection_count, file, part_count, part_size)
-
-        part = 0
-        while part < part_count:
-            tasks = []
-            for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
-            for task in tasks:
-                data = await task
-                if not data:
-                    break
-                yield data
-                part += 1
-                log.debug(f"Part {part} downloaded")
+        connection_count = await self._reserve(connection_count, file_size)
 
-        log.debug("Parallel download finished, cleaning up connections")
-        await self._cleanup()
+        next_part = 0
+        released = 0
+        gate = asyncio.Condition()
+        arrived = asyncio.Queue(maxsize=connection_count)
 
+        async def fetch_parts(sender: DownloadSender) -> None:
+            nonlocal next_part
+            try:
+                while True:
+                    # Senders past the fair share are handed back while other transfers wait
+                    if self.budget and len(self.senders) > 1 and self.budget.should_yield(len(self.senders)):
+                        await self._give_back(sender)
+                        return
+                    async with gate:
+                        if ordered:
+                            await gate.wait_for(lambda: next_part < released + window or next_part >= part_count)
+                        while next_part in skip:
+                            next_part += 1
+                        if next_part >= part_count:
+                            return
+                        index = next_part
+                        next_part += 1
+                    data = await self._fetch_part(sender, index * part_size, part_size)
+                    await arrived.put((index, data))
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8, and a cancelled worker must not wait on a full queue
+                raise
+            except Exception as e:
+                await arrived.put(e)
 
-parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(lambda: asyncio.Lock())
+        workers = []
+        failed = False
+        try:
+            await self._init_download(connection_count, file)
+            workers = [self.loop.create_task(fetch_parts(sender)) for sender in self.senders]
+            held = {}
+            for _ in range(wanted):
+                part = await arrived.get()
+                if isinstance(part, Exception):
+                    raise part
+                index, data = part
+                if not ordered:
+                    yield index * part_size, data
+                    continue
+                held[index] = data
+                while released in held:
+                    yield released * part_size, held.pop(released)
+                    async with gate:
+                        released += 1
+                        gate.notify_all()
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if failed:
+                await self.abort()
+            else:
+                log.debug("Parallel download finished, cleaning up connections")
+                await self._cleanup()
+
+    async def download(self, file: TypeLocation, file_size: int,
+                       part_size_kb: Optional[float] = None,
+                       connection_count: Optional[int] = None,
+                       window: Optional[int] = None) -> AsyncGenerator[bytes, None]:
+        async for _, data in self.download_parts(file, file_size, part_size_kb, connection_count,
+                                                 ordered=True, window=window):
+            yield data
 
 
 def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
@@ -240,69 +828,631 @@ def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
         yield data_read
 
 
+# Writes downloaded parts at their offsets, relative to the position `out` was at, so parts can be
+# committed in any order. Uses os.pwrite where the platform and the file allow it, so the file
+# position is never moved, and falls back to seek and write, e.g. on Windows or for BytesIO.
+class PositionalWriter:
+    out: BinaryIO
+    base: int
+    fd: Optional[int]
+
+    def __init__(self, out: BinaryIO, size: int) -> None:
+        self.out = out
+        self.base = out.tell()
+        self.fd = None
+        if hasattr(os, "pwrite"):
+            try:
+                out.flush()
+                self.fd = out.fileno()
+            except (AttributeError, OSError, ValueError):
+                pass
+        try:
+            # Allocates the whole file up front
+            out.truncate(self.base + size)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def write(self, offset: int, data: bytes) -> None:
+        offset += self.base
+        if self.fd is None:
+            self.out.seek(offset)
+            self.out.write(data)
+            return
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+
+# Reads a file in whole upload parts straight into preallocated buffers. Every part is a memoryview
+# over one of buffer_count buffers, so a view stays valid until buffer_count more parts are read.
+class PartReader:
+    file: BinaryIO
+    part_size: int
+    views: List[memoryview]
+    parts_read: int
+
+    def __init__(self, file: BinaryIO, part_size: int, buffer_count: int = 1) -> None:
+        self.file = file
+        self.part_size = part_size
+        self.views = [memoryview(bytearray(part_size)) for _ in range(buffer_count)]
+        self.parts_read = 0
+
+    def _fill(self, view: memoryview) -> int:
+        readinto = getattr(self.file, "readinto", None)
+        filled = 0
+        while filled < len(view):
+            if readinto:
+                count = readinto(view[filled:])
+            else:
+                data = self.file.read(len(view) - filled)
+                count = len(data)
+                view[filled:filled + count] = data
+            if not count:
+                break
+            filled += count
+        return filled
+
+    def skip_part(self) -> None:
+        self.file.seek(self.part_size, os.SEEK_CUR)
+
+    def read_part(self) -> Optional[memoryview]:
+        view = self.views[self.parts_read % len(self.views)]
+        filled = self._fill(view)
+        if not filled:
+            return None
+        self.parts_read += 1
+        return view[:filled]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        while True:
+            part = self.read_part()
+            if part is None:
+                return
+            yield part
+
+
+# A byte range of a file that reads like a file of its own, so the volumes of a file too big for
+# one upload are read straight from the source by offset instead of being copied to disk first.
+# `name` identifies the volume, e.g. in the upload journal; size and mtime come from the range and
+# the source file.
+class FileSlice:
+    file: BinaryIO
+    name: str
+    offset: int
+    size: int
+    mtime_ns: int
+    position: int
+
+    def __init__(self, path: str, offset: int, size: int, name: Optional[str] = None) -> None:
+        self.file = open(path, "rb")
+        self.name = name or path
+        self.offset = offset
+        self.size = max(0, min(size, os.fstat(self.file.fileno()).st_size - offset))
+        self.mtime_ns = os.fstat(self.file.fileno()).st_mtime_ns
+        self.position = 0
+        self.file.seek(offset)
+
+    def readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        view = memoryview(buffer)[:self.size - self.position]
+        count = self.file.readinto(view) if len(view) else 0
+        self.position += count
+        return count
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self.position
+        data = self.file.read(remaining if size < 0 else min(size, remaining))
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(0, min(base + offset, self.size))
+        self.file.seek(self.offset + self.position)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "FileSlice":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# Runs a PartReader in a worker thread so disk reads and MD5 hashing never block the event loop.
+# At most `depth` parts are read ahead; the slot of a part is only given back once the consumer
+# asks for the next one, so the ring of `depth` buffers is never overwritten while still in use.
+# Parts in `skip` are not yielded, they are only read if the MD5 of the whole file is needed.
+class ReadAhead:
+    reader: PartReader
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue
+    slots: threading.Semaphore
+    hash_md5: Optional["hashlib._Hash"]
+    skip: Set[int]
+    producer: Optional[asyncio.Future]
+
+    def __init__(self, file: BinaryIO, part_size: int, loop: asyncio.AbstractEventLoop, depth: int = 8,
+                 memory_budget: int = 64 * 1024 * 1024, md5: bool = False, skip: Optional[Set[int]] = None
+                 ) -> None:
+        depth = max(1, min(depth, memory_budget // part_size))
+        self.reader = PartReader(file, part_size, buffer_count=depth)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.slots = threading.Semaphore(depth)
+        self.hash_md5 = hashlib.md5() if md5 else None
+        self.skip = skip or set()
+        self.producer = None
+        self.closed = False
+        self.holding = False
+
+    def _produce(self) -> None:
+        try:
+            index = 0
+            while True:
+                if index in self.skip and not self.hash_md5:
+                    self.reader.skip_part()
+                    index += 1
+                    continue
+                self.slots.acquire()
+                if self.closed:
+                    return
+                part = self.reader.read_part()
+                if part is not None and self.hash_md5:
+                    self.hash_md5.update(part)
+                if part is not None and index in self.skip:
+                    self.slots.release()
+                else:
+                    self.loop.call_soon_threadsafe(self.queue.put_nowait,
+                                                   None if part is None else (index, part))
+                if part is None:
+                    return
+                index += 1
+        except Exception as e:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, e)
+
+    def __aiter__(self) -> AsyncIterator[Tuple[int, memoryview]]:
+        if not self.producer:
+            self.producer = self.loop.run_in_executor(None, self._produce)
+        return self
+
+    async def __anext__(self) -> Tuple[int, memoryview]:
+        if self.holding:
+            self.holding = False
+            self.slots.release()
+        part = await self.queue.get()
+        if isinstance(part, Exception):
+            raise part
+        if part is None:
+            raise StopAsyncIteration
+        self.holding = True
+        return part
+
+    async def close(self) -> None:
+        self.closed = True
+        self.slots.release()
+        if self.producer:
+            await self.producer
+
+
+# Remembers the file_id and the acknowledged parts of every upload in progress, so an upload that
+# was interrupted continues with the missing parts. Telegram only keeps parts of files that were
+# never sent for a limited time, so older entries are discarded.
+class UploadJournal:
+    db: sqlite3.Connection
+    max_age: float
+
+    def __init__(self, path: str, max_age: float = 6 * 60 * 60) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS uploads (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                        " file_id INTEGER, part_size INTEGER, started REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parts (file_id INTEGER, part INTEGER,"
+                        " PRIMARY KEY (file_id, part))")
+        self.db.commit()
+        self.max_age = max_age
+
+    def resume(self, path: str, size: int, mtime_ns: int) -> Optional[Tuple[int, int, Set[int]]]:
+        row = self.db.execute("SELECT size, mtime_ns, file_id, part_size, started FROM uploads WHERE path = ?",
+                              (path,)).fetchone()
+        if not row:
+            return None
+        if row[:2] != (size, mtime_ns) or time.time() - row[4] > self.max_age:
+            self.forget(path)
+            return None
+        file_id, part_size = row[2:4]
+        parts = {part for part, in self.db.execute("SELECT part FROM parts WHERE file_id = ?", (file_id,))}
+        return file_id, part_size, parts
+
+    def start(self, path: str, size: int, mtime_ns: int, file_id: int, part_size: int) -> None:
+        self.forget(path)
+        self.db.execute("INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                        (path, size, mtime_ns, file_id, part_size, time.time()))
+        self.db.commit()
+
+    def acknowledge(self, file_id: int, part: int) -> None:
+        self.db.execute("INSERT OR IGNORE INTO parts VALUES (?, ?)", (file_id, part))
+        self.db.commit()
+
+    def forget(self, path: str) -> None:
+        self.db.execute("DELETE FROM parts WHERE file_id IN (SELECT file_id FROM uploads WHERE path = ?)", (path,))
+        self.db.execute("DELETE FROM uploads WHERE path = ?", (path,))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+
 async def _internal_transfer_to_telegram(client: TelegramClient,
                                          response: BinaryIO,
-                                         progress_callback: callable
+                                         progress_callback: callable,
+                                         read_ahead: int = 8,
+                                         memory_budget: int = 64 * 1024 * 1024,
+                                         pipeline_depth: int = 4,
+                                         pool: Optional[SenderPool] = None,
+                                         tuning: Optional[TransferTuning] = None,
+                                         journal: Optional[UploadJournal] = None
                                          ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
-    file_size = os.path.getsize(response.name)
+    if isinstance(response, FileSlice):
+        file_size, mtime_ns = response.size, response.mtime_ns
+    else:
+        stat = os.stat(response.name)
+        file_size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    part_size_kb = None
+    acknowledged = set()
+    if journal:
+        path = os.path.abspath(response.name)
+        resumed = journal.resume(path, file_size, mtime_ns)
+        if resumed:
+            file_id, part_size, acknowledged = resumed
+            part_size_kb = part_size // 1024
+            log.info(f"Resuming upload of {path} with {len(acknowledged)} parts already sent")
 
-    hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
+    def on_part_sent(part: int) -> None:
+        if journal:
+            journal.acknowledge(file_id, part)
+
+    uploader = ParallelTransferrer(client, pool=pool, on_part_sent=on_part_sent)
+    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, part_size_kb=part_size_kb,
+                                                                 pipeline_depth=pipeline_depth,
+                                                                 tuning=tuning)
+    if journal and not acknowledged:
+        journal.start(path, file_size, mtime_ns, file_id, part_size)
+    parts = ReadAhead(response, part_size, uploader.loop, depth=read_ahead, memory_budget=memory_budget,
+                      md5=not is_large, skip=acknowledged)
+    uploaded = min(file_size, len(acknowledged) * part_size)
+    try:
+        async for index, part in parts:
+            await uploader.upload(part, index)
+            uploaded += len(part)
+            if progress_callback:
+                r = progress_callback(uploaded, file_size)
+                if inspect.isawaitable(r):
+                    await r
+        await uploader.finish_upload()
+    except BaseException:
+        await uploader.abort()
+        raise
+    finally:
+        await parts.close()
+    if is_large:
+        return InputFileBig(file_id, part_count, "upload"), file_size
+    else:
+        return InputFile(file_id, part_count, "upload", parts.hash_md5.hexdigest()), file_size
+
+
+async def _internal_stream_to_telegram(client: TelegramClient,
+                                       stream: AsyncIterable[bytes],
+                                       progress_callback: callable,
+                                       part_size_kb: int = 512,
+                                       pipeline_depth: int = 4,
+                                       pool: Optional[SenderPool] = None,
+                                       connection_count: Optional[int] = None,
+                                       tuning: Optional[TransferTuning] = None
+                                       ) -> Tuple[TypeInputFile, int]:
+    file_id = helpers.generate_random_long()
+    part_size = part_size_kb * 1024
+    # Complete parts that were not sent yet. The newest one is held back while the stream could
+    # end right after it, because the last part has to carry the total part count.
+    held = []
     buffer = bytearray()
-    for data in stream_file(response):
+    uploader = None
+    size = 0
+    sent = 0
+
+    async def send(part: bytearray) -> None:
+        nonlocal sent
+        await uploader.upload(part)
+        sent += len(part)
         if progress_callback:
-            r = progress_callback(response.tell(), file_size)
+            r = progress_callback(sent, None)
             if inspect.isawaitable(r):
                 await r
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
-            await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
-    await uploader.finish_upload()
-    if is_large:
-        return InputFileBig(file_id, part_count, "upload"), file_size
-    else:
-        return InputFile(file_id, part_count, "upload", hash_md5.hexdigest()), file_size
+
+    try:
+        async for chunk in stream:
+            buffer += chunk
+            size += len(chunk)
+            while len(buffer) >= part_size:
+                held.append(buffer[:part_size])
+                del buffer[:part_size]
+            # Streams that end within the small file limit are sent as a regular upload instead
+            if not uploader and size > 10 * 1024 * 1024:
+                uploader = ParallelTransferrer(client, pool=pool)
+                await uploader.init_stream_upload(file_id, part_size_kb, connection_count, pipeline_depth, tuning)
+            if uploader:
+                while len(held) > 1 or (held and buffer):
+                    await send(held.pop(0))
+        if buffer:
+            held.append(buffer)
+        if not size:
+            raise ValueError("Cannot upload an empty stream")
+
+        if not uploader:
+            uploader = ParallelTransferrer(client, pool=pool)
+            _, part_count, _ = await uploader.init_upload(file_id, size, part_size_kb=part_size_kb,
+                                                          connection_count=connection_count,
+                                                          pipeline_depth=pipeline_depth)
+            hash_md5 = hashlib.md5()
+            for part in held:
+                hash_md5.update(part)
+                await send(part)
+            await uploader.finish_upload()
+            return InputFile(file_id, part_count, "upload", hash_md5.hexdigest()), size
+
+        part_count = uploader.next_part + len(held)
+        uploader.set_part_count(part_count)
+        for part in held:
+            await send(part)
+        await uploader.finish_upload()
+        return InputFileBig(file_id, part_count, "upload"), size
+    except BaseException:
+        if uploader:
+            await uploader.abort()
+        raise
 
 
 async def download_file(client: TelegramClient,
                         location: TypeLocation,
                         out: BinaryIO,
-                        progress_callback: callable = None
+                        progress_callback: callable = None,
+                        pool: Optional[SenderPool] = None,
+                        connection_count: Optional[int] = None,
+                        part_size_kb: Optional[float] = None,
+                        skip: Optional[Set[int]] = None,
+                        on_part_written: Optional[Callable[[int], None]] = None
                         ) -> BinaryIO:
+    # Parts in `skip` are already in `out`, e.g. from an interrupted download, and keep the part
+    # size they were written with. on_part_written gets the index of every part once it is written.
     size = location.size
     dc_id, location = utils.get_input_location(location)
-    # We lock the transfers because telegram has connection count limits
-    downloader = ParallelTransferrer(client, dc_id)
-    downloaded = downloader.download(location, size)
-    async for x in downloaded:
-        out.write(x)
+    part_size = int((part_size_kb or utils.get_appropriated_part_size(size)) * 1024)
+    downloader = ParallelTransferrer(client, dc_id, pool=pool)
+    writer = PositionalWriter(out, size)
+    committed = min(size, len(skip or ()) * part_size)
+    async for offset, data in downloader.download_parts(location, size, part_size / 1024, connection_count,
+                                                        skip=skip):
+        # Disk writes run in a thread so a slow disk doesn't hold up the senders
+        await downloader.loop.run_in_executor(None, writer.write, offset, data)
+        if on_part_written:
+            on_part_written(offset // part_size)
+        committed += len(data)
         if progress_callback:
-            r = progress_callback(out.tell(), size)
+            r = progress_callback(committed, size)
             if inspect.isawaitable(r):
                 await r
 
+    out.seek(writer.base + size)
     return out
 
 
+# Everything an upload worker process needs to open its own connections to the home DC and send
+# parts of a file, which must be picklable. offset and size select the byte range that is uploaded.
+class ShardSpec(NamedTuple):
+    path: str
+    offset: int
+    size: int
+    file_id: int
+    part_size_kb: int
+    dc_id: int
+    ip_address: str
+    port: int
+    auth_key: bytes
+    connection: Any
+    proxy: Any
+    connections: int
+    pipeline_depth: int
+    chunk_parts: int
+
+
+class _ShardLoggers(dict):
+    def __missing__(self, key: str) -> logging.Logger:
+        return logging.getLogger(key)
+
+
+# Stands in for the TelegramClient inside an upload worker process. It only knows the home DC and
+# its auth key, which is all the senders of a ParallelTransferrer need there.
+class _ShardClient:
+    spec: ShardSpec
+
+    def __init__(self, spec: ShardSpec) -> None:
+        self.spec = spec
+        self.session = SimpleNamespace(dc_id=spec.dc_id, auth_key=AuthKey(spec.auth_key))
+        self._log = _ShardLoggers()
+        self._connection = spec.connection
+        self._proxy = spec.proxy
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return asyncio.get_running_loop()
+
+    async def _get_dc(self, dc_id: int) -> SimpleNamespace:
+        return SimpleNamespace(id=dc_id, ip_address=self.spec.ip_address, port=self.spec.port)
+
+    async def _call(self, sender: MTProtoSender, request: Any) -> Any:
+        return await sender.send(request)
+
+
+async def _upload_shard(spec: ShardSpec, claims: Any, completions: Any) -> None:
+    uploader = ParallelTransferrer(_ShardClient(spec), spec.dc_id,
+                                   on_part_sent=lambda part: completions.put(("part", part)))
+    part_size, part_count, _ = await uploader.init_upload(spec.file_id, spec.size, part_size_kb=spec.part_size_kb,
+                                                          connection_count=spec.connections,
+                                                          pipeline_depth=spec.pipeline_depth)
+    loop = asyncio.get_running_loop()
+    try:
+        with FileSlice(spec.path, spec.offset, spec.size) as file:
+            # UploadSender copies every part before the next read, so one buffer is enough
+            reader = PartReader(file, part_size)
+            while True:
+                # Parts are claimed in chunks, so every worker reads long runs of the file in order
+                with claims.get_lock():
+                    start = claims.value
+                    end = claims.value = min(part_count, start + spec.chunk_parts)
+                if start >= part_count:
+                    break
+                file.seek(start * part_size)
+                for index in range(start, end):
+                    await uploader.upload(await loop.run_in_executor(None, reader.read_part), index)
+        await uploader.finish_upload()
+    except BaseException:
+        await uploader.abort()
+        raise
+
+
+def _sharded_upload_worker(spec: ShardSpec, claims: Any, completions: Any) -> None:
+    try:
+        asyncio.run(_upload_shard(spec, claims, completions))
+    except BaseException as e:
+        # Exceptions of telethon can't always be pickled
+        completions.put(("error", repr(e)))
+    else:
+        completions.put(("done", None))
+
+
+async def upload_file_sharded(client: TelegramClient,
+                              path: str,
+                              progress_callback: callable = None,
+                              processes: Optional[int] = None,
+                              connections_per_process: int = 4,
+                              pipeline_depth: int = 4,
+                              part_size_kb: int = 512,
+                              chunk_parts: int = 16,
+                              offset: int = 0,
+                              size: Optional[int] = None,
+                              pool: Optional[SenderPool] = None
+                              ) -> TypeInputFile:
+    # Encrypting and sending parts is bound to the single thread of the client's event loop. Here
+    # worker processes each open their own connections to the home DC with the session's auth key
+    # and send parts of the same file_id, read straight from the file by offset, while this
+    # coordinator counts the acknowledged parts and builds the InputFileBig. Only big files have no
+    # MD5 to compute over the whole file, so smaller ones go through upload_file. Every call starts
+    # fresh interpreters that import telethon and connect to the DC, which takes a few seconds, so
+    # this only pays off for files that take much longer than that to upload.
+    file_size = os.path.getsize(path)
+    size = max(0, min(file_size - offset, file_size if size is None else size))
+    if size <= 10 * 1024 * 1024:
+        with FileSlice(path, offset, size) as file:
+            return await upload_file(client, file, progress_callback, pool=pool)
+
+    dc_id = client.session.dc_id
+    processes = max(1, processes or os.cpu_count() or 1)
+    connections_per_process = max(1, connections_per_process)
+    budget = pool.budget if pool else None
+    if budget:
+        granted = await budget.acquire(dc_id, processes * connections_per_process, size)
+        processes = min(processes, granted)
+        connections_per_process = max(1, min(connections_per_process, granted // processes))
+    try:
+        dc = await client._get_dc(dc_id)
+        part_size = part_size_kb * 1024
+        part_count = (size + part_size - 1) // part_size
+        spec = ShardSpec(path, offset, size, helpers.generate_random_long(), part_size_kb, dc_id, dc.ip_address,
+                         dc.port, client.session.auth_key.key, client._connection, client._proxy,
+                         connections_per_process, pipeline_depth, chunk_parts)
+        log.debug(f"Starting sharded upload: {processes} processes with {connections_per_process} senders,"
+                  f" {part_count} parts of {path}")
+
+        # Spawned workers start without the client's event loop and threads
+        context = multiprocessing.get_context("spawn")
+        claims = context.Value("q", 0)
+        completions = context.Queue()
+        workers = [context.Process(target=_sharded_upload_worker, args=(spec, claims, completions), daemon=True)
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        loop = asyncio.get_running_loop()
+        sent = set()
+        uploaded = 0
+        running = len(workers)
+        try:
+            while running:
+                try:
+                    kind, value = await loop.run_in_executor(None, completions.get, True, 1)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        break
+                    continue
+                if kind == "error":
+                    raise RuntimeError(f"Upload worker failed: {value}")
+                if kind == "done":
+                    running -= 1
+                    continue
+                if value not in sent:
+                    sent.add(value)
+                    uploaded += min(part_size, size - value * part_size)
+                    if progress_callback:
+                        r = progress_callback(uploaded, size)
+                        if inspect.isawaitable(r):
+                            await r
+        finally:
+            for worker in workers:
+                if worker.is_alive() and running:
+                    worker.terminate()
+            await loop.run_in_executor(None, lambda: [worker.join() for worker in workers])
+            completions.close()
+    finally:
+        if budget:
+            budget.release(dc_id, granted, finished=True)
+
+    if len(sent) < part_count:
+        raise RuntimeError(f"{part_count - len(sent)} parts of {path} were not acknowledged")
+    return InputFileBig(spec.file_id, part_count, "upload")
+
+
 async def upload_file(client: TelegramClient,
                       file: BinaryIO,
                       progress_callback: callable = None,
-
+                      read_ahead: int = 8,
+                      memory_budget: int = 64 * 1024 * 1024,
+                      pipeline_depth: int = 4,
+                      pool: Optional[SenderPool] = None,
+                      tuning: Optional[TransferTuning] = None,
+                      journal: Optional[UploadJournal] = None,
                       ) -> TypeInputFile:
-    res = (await _internal_transfer_to_telegram(client, file, progress_callback))[0]
+    res = (await _internal_transfer_to_telegram(client, file, progress_callback, read_ahead=read_ahead,
+                                                memory_budget=memory_budget, pipeline_depth=pipeline_depth,
+                                                pool=pool, tuning=tuning, journal=journal))[0]
     return res
+
+
+async def upload_stream(client: TelegramClient,
+                        stream: AsyncIterable[bytes],
+                        progress_callback: callable = None,
+                        part_size_kb: int = 512,
+                        pipeline_depth: int = 4,
+                        pool: Optional[SenderPool] = None,
+                        connection_count: Optional[int] = None,
+                        tuning: Optional[TransferTuning] = None,
+                        ) -> Tuple[TypeInputFile, int]:
+    return await _internal_stream_to_telegram(client, stream, progress_callback, part_size_kb=part_size_kb,
+                                              pipeline_depth=pipeline_depth, pool=pool,
+                                              connection_count=connection_count, tuning=tuning)
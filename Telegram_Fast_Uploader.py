@@ -8,23 +8,435 @@ import ffmpeg
 import shutil
 import subprocess
 import mimetypes
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import json
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import MappingProxyType
 from tqdm import tqdm
 from telethon import TelegramClient, utils
-from telethon.tl.types import InputMediaUploadedDocument, DocumentAttributeVideo, DocumentAttributeFilename
-from FastTelethon import upload_file
+from telethon.tl.types import (InputMediaUploadedDocument, DocumentAttributeVideo, DocumentAttributeFilename,
+                               InputMediaDocument, InputDocument, MessageEntityBold, Channel)
+from telethon.errors import (FilePartMissingError, FilePartsInvalidError, FileReferenceExpiredError,
+                             FileReferenceInvalidError, MediaEmptyError)
+from FastTelethon import (upload_file, upload_file_sharded, upload_stream, download_file, SenderPool, ConnectionBudget,
+                          TransferTuning, UploadJournal, FileSlice)
 
 # Constants
 API_ID = ''
 API_HASH = ''
 SESSION_FILE = 'session_name'
+TUNING_FILE = f'{SESSION_FILE}.tuning.json'  # Connection count and part size learned per DC
+JOURNAL_FILE = f'{SESSION_FILE}.uploads.sqlite'  # Parts of interrupted uploads, to resume them
+MANIFEST_FILE = f'{SESSION_FILE}.manifest.sqlite'  # Files already posted, per chat
+PROBE_CACHE_FILE = f'{SESSION_FILE}.probes.sqlite'  # ffprobe results of the files seen so far
+DOWNLOAD_LEDGER_FILE = '.telegram_downloads.sqlite'  # Kept in the download folder, parts and hashes of the files
 STREAMABLE_VIDEO_FORMAT = '.mp4'
 SIZE_LIMIT_2GB = 2 * 1024 * 1024 * 1024
 SIZE_LIMIT_4GB = 4 * 1024 * 1024 * 1024
+SPLIT_SIZE = 4000 * 1024 * 1024  # Files larger than this are uploaded in parts of at most this size, 8000 parts of 512 KiB
+SPLIT_TEMP_PREFIX = '.telegram_split_'  # Video parts are cut into a folder with this prefix, never indexed for upload
+SPLIT_ATTEMPTS = 4  # Segment lengths tried when cutting a video into parts under the split size
+READ_AHEAD_PARTS = 8  # Upload parts read from disk ahead of the network
+READ_AHEAD_MEMORY = 64 * 1024 * 1024  # Upper bound for the memory held by read-ahead parts
+UPLOAD_PIPELINE_DEPTH = 4  # Parts in flight on each upload connection
+SENDER_IDLE_TIMEOUT = 300  # Seconds an unused upload connection is kept open for the next file
+PARALLEL_FILES = 4  # Files uploaded at the same time
+UNPOSTED_FILES = 32  # Files uploaded ahead of the message posted next, e.g. while an earlier video converts
+CONNECTION_BUDGET = 20  # Connections shared by all uploads and downloads in flight
+UPLOAD_PROCESSES = 0  # Worker processes sending the parts of each big file, 0 sends them from this process
+SHARDED_UPLOAD_MIN_SIZE = 256 * 1024 * 1024  # Smaller files are sent from this process, starting the workers costs more
+THUMBNAIL_POSITION = 0.1  # Fraction of the video the thumbnail is taken at, past intros and black frames
+SCAN_WORKERS = 8  # Directories listed at the same time when indexing the folder, helps most on network shares
+MEDIA_TOOL_PROCESSES = 4  # ffprobe/ffmpeg processes the upload runs at the same time for metadata and thumbnails
+ALBUM_SIZE = 10  # Most media Telegram groups into one album
+CONVERSION_WORKERS = 2  # Videos converted to MP4 at the same time while other files upload
+REMUX_VIDEO_CODECS = ('h264', 'hevc')  # Video codecs copied into the MP4 as they are
+REMUX_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')  # 8-bit 4:2:0, the format a full conversion produces
+REMUX_AUDIO_CODECS = ('aac', 'mp3')  # Audio codecs copied as they are, others are encoded to AAC
+TEXT_SUBTITLE_CODECS = ('subrip', 'ass', 'ssa', 'webvtt', 'mov_text', 'text')  # Subtitles mov_text can hold
+TRANSCODE_WORKERS = 1  # ffmpeg processes encoding segments of one video, 1 encodes it in a single process
+SEGMENTS_PER_WORKER = 4  # Segments cut per transcode worker, so no worker idles while the last one finishes
+MIN_SEGMENT_SECONDS = 10  # Shorter segments cost more in encoder startup than they gain in parallelism
+STREAM_CHUNK_SIZE = 1024 * 1024  # Bytes read from the ffmpeg pipe at a time when streaming a conversion
 
-class TelegramUploader:
+class UploadManifest:
+    """
+    Persistent record of the files posted to a chat, keyed by their path relative to the parent
+    of the uploaded folder. A file counts as uploaded while its size and mtime are unchanged.
+    Documents are also indexed by content hash, so identical files can be posted again without
+    uploading them.
+    """
+    def __init__(self, path, chat_id):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (chat_id INTEGER, rel_path TEXT, size INTEGER,"
+                        " mtime_ns INTEGER, content_hash TEXT, message_id INTEGER, PRIMARY KEY (chat_id, rel_path))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents (content_hash TEXT PRIMARY KEY, document_id INTEGER,"
+                        " access_hash INTEGER, file_reference BLOB, chat_id INTEGER, message_id INTEGER)")
+        self.db.commit()
+        self.chat_id = chat_id
+        # The whole chat is loaded once so every lookup during the walk is a dict access
+        self.entries = {
+            rel_path: (size, mtime_ns, content_hash, message_id)
+            for rel_path, size, mtime_ns, content_hash, message_id in self.db.execute(
+                "SELECT rel_path, size, mtime_ns, content_hash, message_id FROM files WHERE chat_id = ?",
+                (chat_id,))
+        }
+
+    def is_uploaded(self, rel_path, size, mtime_ns):
+        entry = self.entries.get(rel_path)
+        return entry is not None and entry[:2] == (size, mtime_ns)
+
+    def record(self, rel_path, size, mtime_ns, message_id, content_hash=None):
+        self.entries[rel_path] = (size, mtime_ns, content_hash, message_id)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        (self.chat_id, rel_path, size, mtime_ns, content_hash, message_id))
+        self.db.commit()
+
+    def find_document(self, content_hash):
+        """Returns tuple of (InputDocument, chat_id, message_id) or None."""
+        row = self.db.execute("SELECT document_id, access_hash, file_reference, chat_id, message_id FROM documents"
+                              " WHERE content_hash = ?", (content_hash,)).fetchone()
+        if not row:
+            return None
+        return InputDocument(row[0], row[1], row[2]), row[3], row[4]
+
+    def record_document(self, content_hash, document, chat_id, message_id):
+        self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                        (content_hash, document.id, document.access_hash, document.file_reference,
+                         chat_id, message_id))
+        self.db.commit()
+
+    def forget_document(self, content_hash):
+        self.db.execute("DELETE FROM documents WHERE content_hash = ?", (content_hash,))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class DownloadLedger:
+    """
+    Sidecar record of a chat downloaded into a folder, keyed by message. Holds the parts written of
+    every file still downloading, and the size, mtime and SHA-256 of every finished one, so an
+    interrupted download continues with the missing parts and complete files are skipped.
+    """
+    def __init__(self, path, chat_id):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (chat_id INTEGER, message_id INTEGER, path TEXT,"
+                        " size INTEGER, part_size INTEGER, mtime_ns INTEGER, sha256 TEXT,"
+                        " PRIMARY KEY (chat_id, message_id))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parts (chat_id INTEGER, message_id INTEGER, part INTEGER,"
+                        " PRIMARY KEY (chat_id, message_id, part))")
+        self.db.commit()
+        self.chat_id = chat_id
+
+    def status(self, message_id):
+        """Returns tuple of (path, size, part_size, mtime_ns, sha256) or None, sha256 is None until the file is complete."""
+        return self.db.execute("SELECT path, size, part_size, mtime_ns, sha256 FROM files"
+                               " WHERE chat_id = ? AND message_id = ?", (self.chat_id, message_id)).fetchone()
+
+    def written_parts(self, message_id):
+        return {part for part, in self.db.execute("SELECT part FROM parts WHERE chat_id = ? AND message_id = ?",
+                                                  (self.chat_id, message_id))}
+
+    def start(self, message_id, path, size, part_size):
+        self.db.execute("DELETE FROM parts WHERE chat_id = ? AND message_id = ?", (self.chat_id, message_id))
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                        (self.chat_id, message_id, path, size, part_size))
+        self.db.commit()
+
+    def part_written(self, message_id, part):
+        self.db.execute("INSERT OR IGNORE INTO parts VALUES (?, ?, ?)", (self.chat_id, message_id, part))
+        self.db.commit()
+
+    def complete(self, message_id, path, size, mtime_ns, sha256):
+        self.db.execute("DELETE FROM parts WHERE chat_id = ? AND message_id = ?", (self.chat_id, message_id))
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL, ?, ?)",
+                        (self.chat_id, message_id, path, size, mtime_ns, sha256))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class ProbeCache:
+    """
+    ffprobe results keyed by path, size and mtime, so the conversion, thumbnail and metadata steps
+    probe every file once, and video thumbnails keyed by content. Kept in memory, and also on disk
+    once open() is called.
+    """
     def __init__(self):
+        self.entries = {}
+        self.thumbnails = {}
+        self.db = None
+        # Conversions probe from the conversion pool threads
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER,"
+                            " mtime_ns INTEGER, probe TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails (content_key TEXT PRIMARY KEY, jpeg BLOB)")
+            self.db.commit()
+
+    def lookup(self, file_path):
+        """Returns tuple of (key, probe), probe is None if the file has to be probed."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.entries:
+                return key, self.entries[key]
+            if self.db:
+                row = self.db.execute("SELECT probe FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                      key).fetchone()
+                if row:
+                    self.entries[key] = json.loads(row[0])
+                    return key, self.entries[key]
+        return key, None
+
+    def store(self, key, probe):
+        with self.lock:
+            self.entries[key] = probe
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)", key + (json.dumps(probe),))
+                self.db.commit()
+
+    def probe(self, file_path):
+        key, probe = self.lookup(file_path)
+        if probe is None:
+            probe = ffmpeg.probe(file_path)
+            if self.needs_duration(probe):
+                for cmd in self.packet_duration_commands(file_path):
+                    end = self.packet_end(subprocess.run(cmd, capture_output=True, text=True).stdout)
+                    if end:
+                        probe['format']['duration'] = str(end)
+                        break
+            self.store(key, probe)
+        return probe
+
+    def thumbnail(self, content_key):
+        with self.lock:
+            if content_key not in self.thumbnails and self.db:
+                row = self.db.execute("SELECT jpeg FROM thumbnails WHERE content_key = ?", (content_key,)).fetchone()
+                if row:
+                    self.thumbnails[content_key] = row[0]
+            return self.thumbnails.get(content_key)
+
+    def store_thumbnail(self, content_key, jpeg):
+        with self.lock:
+            self.thumbnails[content_key] = jpeg
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?)", (content_key, jpeg))
+                self.db.commit()
+
+    @staticmethod
+    def content_key(file_path, sample_size=1024 * 1024):
+        """
+        Hash of the size and of samples from the start, middle and end of a file. It identifies the
+        content across renames without reading the whole file.
+        """
+        size = os.path.getsize(file_path)
+        digest = hashlib.sha256(str(size).encode())
+        with open(file_path, 'rb') as file:
+            for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+                file.seek(offset)
+                digest.update(file.read(sample_size))
+        return digest.hexdigest()
+
+    @staticmethod
+    def needs_duration(probe):
+        has_video = any(stream['codec_type'] == 'video' for stream in probe['streams'])
+        return has_video and 'duration' not in probe['format']
+
+    @staticmethod
+    def packet_duration_commands(file_path):
+        """
+        ffprobe commands listing the timestamps of the last video packets, for files whose container
+        doesn't store a duration. Nothing is decoded: the first seeks to the end, the second reads
+        the packet index for containers that can't seek that far.
+        """
+        return [['ffprobe', '-v', 'error', '-select_streams', 'v:0', *read_intervals,
+                 '-show_entries', 'packet=pts_time,duration_time', '-of', 'csv=p=0', file_path]
+                for read_intervals in (['-read_intervals', '999999999%+#500'], [])]
+
+    @staticmethod
+    def packet_end(output):
+        end = 0
+        for line in output.splitlines():
+            values = line.split(',')
+            try:
+                end = max(end, float(values[0]) + (float(values[1]) if len(values) > 1 else 0))
+            except ValueError:
+                continue
+        return end
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+probe_cache = ProbeCache()
+
+class MediaTools:
+    """
+    Runs ffprobe and ffmpeg as asyncio subprocesses, at most max_processes at a time, so probing
+    and thumbnailing the next files doesn't block the event loop and the uploads running on it.
+    """
+    def __init__(self, max_processes):
+        self.semaphore = asyncio.Semaphore(max_processes)
+
+    async def run(self, cmd, check=True):
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+        if check and process.returncode != 0:
+            raise ffmpeg.Error(cmd[0], stdout, stderr)
+        return stdout
+
+    async def probe(self, file_path):
+        """Same as probe_cache.probe, and shares its results."""
+        key, probe = probe_cache.lookup(file_path)
+        if probe is None:
+            probe = json.loads(await self.run(['ffprobe', '-show_format', '-show_streams', '-of', 'json', file_path]))
+            if ProbeCache.needs_duration(probe):
+                for cmd in ProbeCache.packet_duration_commands(file_path):
+                    end = ProbeCache.packet_end((await self.run(cmd, check=False)).decode())
+                    if end:
+                        probe['format']['duration'] = str(end)
+                        break
+            probe_cache.store(key, probe)
+        return probe
+
+class UploadSession:
+    """
+    A Telegram account files are uploaded with, with its own connections and connection budget.
+    Only the primary session posts to the chat, the others hand their files over to it.
+    """
+    def __init__(self, client, sender_pool, primary=False):
+        self.client = client
+        self.sender_pool = sender_pool
+        self.primary = primary
+        self.uploading = 0
+
+# A file of the indexed folder, with everything the upload needs to know about it before reading it
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'mtime_ns', 'mime_type', 'size_class'])
+# Files and subdirectory paths of a directory, both in natural sort order
+DirectoryEntry = namedtuple('DirectoryEntry', ['path', 'files', 'dirs'])
+
+class FolderIndex:
+    """
+    Immutable index of a folder tree, built in one os.scandir pass that lists subtrees in parallel.
+    The file issue check, the file count and the upload plan all read it instead of walking the
+    folder again.
+    """
+    def __init__(self, root, directories):
+        self.root = root
+        self.directories = MappingProxyType(directories)
+        self.files = MappingProxyType({entry.path: entry for directory in directories.values()
+                                       for entry in directory.files})
+
+    @classmethod
+    def scan(cls, root, workers=SCAN_WORKERS):
+        # guess_type loads the MIME database on first use, which isn't safe from several threads
+        mimetypes.init()
+        directories = {}
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            pending = {pool.submit(cls.scan_directory, root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory = future.result()
+                    directories[directory.path] = directory
+                    pending |= {pool.submit(cls.scan_directory, path) for path in directory.dirs}
+        return cls(root, directories)
+
+    @staticmethod
+    def scan_directory(path):
+        files = []
+        dirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Left behind by an interrupted split upload
+                        if not entry.name.startswith(SPLIT_TEMP_PREFIX):
+                            dirs.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files.append(FileEntry(entry.path, stat.st_size, stat.st_mtime_ns,
+                                               mimetypes.guess_type(entry.name)[0],
+                                               FolderIndex.size_class(stat.st_size)))
+        except OSError as e:
+            print(f'Failed to list {path}: {e}')
+        files.sort(key=lambda entry: TelegramUploader.natural_sort_key(os.path.basename(entry.path)))
+        dirs.sort(key=lambda dir_path: TelegramUploader.natural_sort_key(os.path.basename(dir_path)))
+        return DirectoryEntry(path, tuple(files), tuple(dirs))
+
+    @staticmethod
+    def size_class(size):
+        if size > SIZE_LIMIT_4GB:
+            return 'over_4gb'
+        if size > SIZE_LIMIT_2GB:
+            return 'over_2gb'
+        return 'normal'
+
+    def without(self, paths):
+        """Returns a new index without the given files."""
+        paths = set(paths)
+        return FolderIndex(self.root, {
+            path: directory._replace(files=tuple(entry for entry in directory.files if entry.path not in paths))
+            for path, directory in self.directories.items()
+        })
+
+class TelegramUploader:
+    def __init__(self, parallel_files=PARALLEL_FILES, connection_budget=CONNECTION_BUDGET, adaptive=True,
+                 dedup=False, stream_convert=False, conversion_workers=CONVERSION_WORKERS,
+                 transcode_workers=TRANSCODE_WORKERS, albums=False, split_size=SPLIT_SIZE,
+                 upload_processes=UPLOAD_PROCESSES, helper_sessions=(), staging_chat=None):
         self.client = TelegramClient(SESSION_FILE, API_ID, API_HASH)
-        self.uploaded_files = set()
+        self.parallel_files = max(1, parallel_files)
+        self.connection_budget = max(1, connection_budget)
+        self.dedup = dedup
+        self.albums = albums
+        self.split_size = split_size
+        self.upload_processes = upload_processes
+        self.stream_convert = stream_convert
+        self.stream_conversions = {}  # Videos converted while uploading: path -> (quality, subtitle_index)
+        self.conversions = {}  # MP4s converted during the upload: output path -> (video, quality, subtitle_index)
+        self.replaced = {}  # Videos deleted once their conversion succeeds: video -> output path
+        self.converting = {}  # Output path -> future of its conversion
+        self.conversion_pool = ThreadPoolExecutor(max(1, conversion_workers))
+        self.transcode_workers = max(1, transcode_workers)
+        self.tuning = TransferTuning(TUNING_FILE) if adaptive else None
+        self.journal = UploadJournal(JOURNAL_FILE)
+        self.sender_pool = SenderPool(self.client, idle_timeout=SENDER_IDLE_TIMEOUT,
+                                      budget=ConnectionBudget(self.connection_budget))
+        self.sessions = [UploadSession(self.client, self.sender_pool, primary=True)]
+        for session_file in helper_sessions:
+            client = TelegramClient(session_file, API_ID, API_HASH)
+            self.sessions.append(UploadSession(client, SenderPool(client, idle_timeout=SENDER_IDLE_TIMEOUT,
+                                                                  budget=ConnectionBudget(self.connection_budget))))
+        self.staging_chat = staging_chat  # Chat helper sessions post their uploads to for the primary one
+        self.manifest = None
+        self.root_folder = None
+        self.index = None
+        probe_cache.open(PROBE_CACHE_FILE)
+        self.media_tools = MediaTools(MEDIA_TOOL_PROCESSES)
 
     async def list_chats(self):
         """List all available chats and their IDs without requiring a chat ID input."""
@@ -57,10 +469,13 @@ class TelegramUploader:
     def natural_sort_key(s):
         return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', s)]
 
-    @staticmethod
-    def create_thumbnail(input_video, output_thumb, max_size=320):
+    async def create_thumbnail(self, input_video, max_size=320):
+        """
+        Render a JPEG thumbnail of a video into memory. Only the keyframe after the seek point is
+        decoded. Returns the JPEG bytes or None.
+        """
         try:
-            probe = ffmpeg.probe(input_video)
+            probe = await self.media_tools.probe(input_video)
             video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
             if video_stream is None:
                 print(f'No video stream found in {input_video}')
@@ -69,14 +484,17 @@ class TelegramUploader:
             width, height = int(video_stream['width']), int(video_stream['height'])
             scale = min(max_size / width, max_size / height)
             new_width, new_height = int(width * scale), int(height * scale)
+            duration = float(probe['format'].get('duration', 0))
+            position = duration * THUMBNAIL_POSITION if duration > 10 else min(1, duration / 2)
 
-            (ffmpeg
-             .input(input_video, ss=1)
-             .filter('scale', new_width, new_height)
-             .output(output_thumb, vframes=1)
-             .overwrite_output()
-             .run(quiet=True))
-            return output_thumb
+            # -ss before the input seeks the demuxer to the keyframe, and skip_frame stops the
+            # decoder from touching anything but keyframes
+            jpeg = await self.media_tools.run(ffmpeg
+                                              .input(input_video, ss=f'{position:.3f}', skip_frame='nokey')
+                                              .filter('scale', new_width, new_height)
+                                              .output('pipe:', vframes=1, format='image2pipe', vcodec='mjpeg')
+                                              .compile())
+            return jpeg or None
         except ffmpeg.Error as e:
             print(f'Error creating thumbnail: {e}')
             return None
@@ -93,23 +511,20 @@ class TelegramUploader:
         return mime_type and mime_type.startswith('video/')
 
     @staticmethod
-    def check_file_issues(folder_path):
+    def check_file_issues(index):
         non_streamable_videos = []
         files_exceeding_2gb = []
         files_exceeding_4gb = []
 
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_size = os.path.getsize(file_path)
-
-                if TelegramUploader.is_video_file(file_path) and not TelegramUploader.is_streamable_video(file_path):
-                    non_streamable_videos.append(file_path)
+        for entry in index.files.values():
+            is_video = entry.mime_type and entry.mime_type.startswith('video/')
+            if is_video and os.path.splitext(entry.path)[1].lower() != STREAMABLE_VIDEO_FORMAT:
+                non_streamable_videos.append(entry.path)
 
-                if file_size > SIZE_LIMIT_4GB:
-                    files_exceeding_4gb.append(file_path)
-                elif file_size > SIZE_LIMIT_2GB:
-                    files_exceeding_2gb.append(file_path)
+            if entry.size_class == 'over_4gb':
+                files_exceeding_4gb.append(entry.path)
+            elif entry.size_class == 'over_2gb':
+                files_exceeding_2gb.append(entry.path)
 
         return non_streamable_videos, files_exceeding_2gb, files_exceeding_4gb
 
@@ -124,7 +539,7 @@ class TelegramUploader:
     @staticmethod
     def get_subtitle_tracks(input_file):
         try:
-            probe = ffmpeg.probe(input_file)
+            probe = probe_cache.probe(input_file)
             subtitle_tracks = [stream for stream in probe['streams'] if stream['codec_type'] == 'subtitle']
             return subtitle_tracks
         except ffmpeg.Error as e:
@@ -176,79 +591,146 @@ class TelegramUploader:
                 print("Invalid choice. Please enter 1, 2, or 3.")
 
     @staticmethod
-    def convert_to_mp4(input_file, output_file, quality='original', subtitle_index=None):
-            if os.path.exists(output_file):
-                action = input(f"Output file {output_file} already exists. (O)verwrite, (B)ackup, or (S)kip? ").lower()
-                if action == 'b':
-                    backup_dir = os.path.join(os.path.dirname(output_file), 'backups')
-                    os.makedirs(backup_dir, exist_ok=True)
-                    backup_file = os.path.join(backup_dir, os.path.basename(output_file))
-                    shutil.move(output_file, backup_file)
-                    print(f"Backed up existing file to {backup_file}")
-                elif action == 's':
-                    print(f"Skipping conversion of {input_file}")
-                    return True
+    def build_output_args(input_file, probe, quality='original', subtitle_index=None):
+        """
+        Build the ffmpeg output arguments of a conversion to streamable MP4.
+        Returns tuple of (output_args, subtitle_file), subtitle_file is the extracted subtitle to
+        burn in that has to be removed afterwards, or None.
+        """
+        # Determine if we should use GPU acceleration
+        use_gpu = TelegramUploader.check_for_gpu()
+        if use_gpu:
+            vcodec = 'hevc_nvenc'
+            preset = 'p7'  # A high-quality preset for NVENC
+        else:
+            vcodec = 'libx265'
+            preset = 'slow'  # A high-quality preset for CPU encoding
+
+        # Prepare FFmpeg command
+        output_args = {
+            'vcodec': vcodec,
+            'acodec': 'aac',
+            'preset': preset
+        }
+
+        # Handle subtitle burning
+        subtitle_file = None
+        if subtitle_index is not None:
+            subtitle_file = f"{os.path.splitext(input_file)[0]}_subtitle.srt"
+            if TelegramUploader.extract_subtitle(input_file, subtitle_index, subtitle_file):
+                # Use the extracted subtitle file
+                output_args['vf'] = output_args.get('vf', '') + f",subtitles='{subtitle_file}'"
+                output_args['vf'] = output_args['vf'].lstrip(',')
+            else:
+                subtitle_file = None
+        
+        # Set quality-specific parameters
+        if quality == '720p':
+            output_args.update({
+                'vf': 'scale=-2:720',
+                'crf': '23',
+                'b:a': '128k'
+            })
+        elif quality == '1080p':
+            output_args.update({
+                'vf': 'scale=-2:1080',
+                'crf': '21',
+                'b:a': '192k'
+            })
+        else:  # original
+            output_args.update({
+                'crf': '18',
+                'b:a': '320k'
+            })
+
+        # Handle subtitle tracks
+        subtitle_tracks = [stream for stream in probe['streams'] if stream['codec_type'] == 'subtitle']
+        if subtitle_tracks:
+            output_args['map'] = '0'  # Map all streams from input
+            output_args['c:s'] = 'mov_text'  # Convert subtitles to mov_text format for MP4 compatibility
+
+        # Force pixel format to 8-bit
+        output_args['pix_fmt'] = 'yuv420p'
+
+        return output_args, subtitle_file
+
+    @staticmethod
+    def resolve_existing_output(input_file, output_file):
+        """
+        Ask what to do with an output file left by an earlier conversion.
+        Returns False if the conversion should be skipped.
+        """
+        if os.path.exists(output_file):
+            action = input(f"Output file {output_file} already exists. (O)verwrite, (B)ackup, or (S)kip? ").lower()
+            if action == 'b':
+                backup_dir = os.path.join(os.path.dirname(output_file), 'backups')
+                os.makedirs(backup_dir, exist_ok=True)
+                backup_file = os.path.join(backup_dir, os.path.basename(output_file))
+                shutil.move(output_file, backup_file)
+                print(f"Backed up existing file to {backup_file}")
+            elif action == 's':
+                print(f"Skipping conversion of {input_file}")
+                return False
+        return True
+
+    @staticmethod
+    def build_remux_args(probe, quality='original', subtitle_index=None):
+        """
+        Check whether a video can be put into an MP4 without encoding the video track again.
+        Returns tuple of (stream_indexes, output_args) or None if it has to be converted.
+        """
+        if quality != 'original' or subtitle_index is not None:
+            return None
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        if (not video_stream or video_stream.get('codec_name') not in REMUX_VIDEO_CODECS
+                or video_stream.get('pix_fmt') not in REMUX_PIXEL_FORMATS):
+            return None
+
+        audio_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'audio']
+        # Bitmap subtitles can't be stored as mov_text and are left out
+        subtitle_streams = [stream for stream in probe['streams']
+                            if stream['codec_type'] == 'subtitle' and stream.get('codec_name') in TEXT_SUBTITLE_CODECS]
+        output_args = {'c': 'copy', 'c:s': 'mov_text'}
+        # Apple players and Telegram's iOS client only play HEVC in MP4 with the hvc1 tag, a copy keeps hev1
+        if video_stream['codec_name'] == 'hevc':
+            output_args['tag:v'] = 'hvc1'
+        if any(stream.get('codec_name') not in REMUX_AUDIO_CODECS for stream in audio_streams):
+            output_args.update({'c:a': 'aac', 'b:a': '320k'})
+        stream_indexes = [video_stream['index']] + [stream['index'] for stream in audio_streams + subtitle_streams]
+        return stream_indexes, output_args
+
+    @staticmethod
+    def convert_to_mp4(input_file, output_file, quality='original', subtitle_index=None, ask_overwrite=True,
+                       workers=1):
+            if ask_overwrite and not TelegramUploader.resolve_existing_output(input_file, output_file):
+                return True
 
             # Get video information
-            probe = ffmpeg.probe(input_file)
+            probe = probe_cache.probe(input_file)
             video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-            
+
             if not video_stream:
                 return False
 
-            # Determine if we should use GPU acceleration
-            use_gpu = TelegramUploader.check_for_gpu()
-            if use_gpu:
-                vcodec = 'hevc_nvenc'
-                preset = 'p7'  # A high-quality preset for NVENC
-            else:
-                vcodec = 'libx265'
-                preset = 'slow'  # A high-quality preset for CPU encoding
-
-            # Prepare FFmpeg command
-            output_args = {
-                'vcodec': vcodec,
-                'acodec': 'aac',
-                'preset': preset
-            }
-
-            # Handle subtitle burning
-            if subtitle_index is not None:
-                subtitle_file = f"{os.path.splitext(input_file)[0]}_subtitle.srt"
-                if TelegramUploader.extract_subtitle(input_file, subtitle_index, subtitle_file):
-                    # Use the extracted subtitle file
-                    output_args['vf'] = output_args.get('vf', '') + f",subtitles='{subtitle_file}'"
-                    output_args['vf'] = output_args['vf'].lstrip(',')
-                else:
-                    subtitle_index = None
-            
-            # Set quality-specific parameters
-            if quality == '720p':
-                output_args.update({
-                    'vf': 'scale=-2:720',
-                    'crf': '23',
-                    'b:a': '128k'
-                })
-            elif quality == '1080p':
-                output_args.update({
-                    'vf': 'scale=-2:1080',
-                    'crf': '21',
-                    'b:a': '192k'
-                })
-            else:  # original
-                output_args.update({
-                    'crf': '18',
-                    'b:a': '320k'
-                })
-
-            # Handle subtitle tracks
-            subtitle_tracks = [stream for stream in probe['streams'] if stream['codec_type'] == 'subtitle']
-            if subtitle_tracks:
-                output_args['map'] = '0'  # Map all streams from input
-                output_args['c:s'] = 'mov_text'  # Convert subtitles to mov_text format for MP4 compatibility
+            # Codecs Telegram already plays only need a new container, which takes seconds
+            remux = TelegramUploader.build_remux_args(probe, quality, subtitle_index)
+            if remux:
+                stream_indexes, output_args = remux
+                input_stream = ffmpeg.input(input_file)
+                output_stream = ffmpeg.output(*[input_stream[str(index)] for index in stream_indexes], output_file,
+                                              movflags='+faststart', **output_args)
+                ffmpeg.run(output_stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+                return True
 
-            # Force pixel format to 8-bit
-            output_args['pix_fmt'] = 'yuv420p'
+            # Burned in subtitles are timed against the whole video, and NVENC sessions are limited
+            # per GPU, so both are encoded in a single process
+            if workers > 1 and subtitle_index is None and not TelegramUploader.check_for_gpu():
+                converted = TelegramUploader.convert_to_mp4_segmented(input_file, output_file, quality, workers)
+                if converted is not None:
+                    return converted
+
+            output_args, subtitle_file = TelegramUploader.build_output_args(input_file, probe, quality,
+                                                                            subtitle_index)
 
             # Construct the ffmpeg command
             input_stream = ffmpeg.input(input_file)
@@ -258,11 +740,154 @@ class TelegramUploader:
             ffmpeg.run(output_stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
 
             # Clean up the temporary subtitle file
-            if subtitle_index is not None and os.path.exists(subtitle_file):
+            if subtitle_file and os.path.exists(subtitle_file):
                 os.remove(subtitle_file)
 
             return True
 
+    @staticmethod
+    def convert_to_mp4_segmented(input_file, output_file, quality='original', workers=TRANSCODE_WORKERS):
+        """
+        Convert a video like convert_to_mp4, but cut the video track at keyframes and encode the
+        segments in parallel ffmpeg processes, while the audio is encoded once next to them. The
+        encoded parts are joined with stream copy.
+        Returns True or False like convert_to_mp4, or None if the video is too short to split.
+        """
+        probe = probe_cache.probe(input_file)
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        if not video_stream:
+            return False
+        duration = float(probe['format'].get('duration', 0))
+        if duration < 2 * MIN_SEGMENT_SECONDS:
+            return None
+
+        output_args, _ = TelegramUploader.build_output_args(input_file, probe, quality)
+        video_args = {key: value for key, value in output_args.items() if key not in ('acodec', 'b:a', 'map', 'c:s')}
+        has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+        has_subtitles = 'c:s' in output_args
+        source = ffmpeg.input(input_file)
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as tmp:
+            # The segment muxer only cuts at keyframes, so every segment decodes on its own
+            segment_time = max(MIN_SEGMENT_SECONDS, duration / (workers * SEGMENTS_PER_WORKER))
+            ffmpeg.run(ffmpeg.output(source['v:0'], os.path.join(tmp, 'source_%05d.mkv'), c='copy', f='segment',
+                                     segment_time=f'{segment_time:.3f}', reset_timestamps=1),
+                       overwrite_output=True, capture_stdout=True, capture_stderr=True)
+            segments = sorted(name for name in os.listdir(tmp) if name.startswith('source_'))
+            if len(segments) < 2:
+                return None
+
+            def encode(segment):
+                encoded = os.path.join(tmp, segment.replace('source_', 'encoded_'))
+                ffmpeg.run(ffmpeg.output(ffmpeg.input(os.path.join(tmp, segment)), encoded, an=None, **video_args),
+                           overwrite_output=True, capture_stdout=True, capture_stderr=True)
+                return encoded
+
+            def encode_audio():
+                # Same audio tracks convert_to_mp4 keeps, all of them when it maps every stream
+                audio = os.path.join(tmp, 'audio.mkv')
+                ffmpeg.run(ffmpeg.output(source['a' if has_subtitles else 'a:0'], audio, acodec='aac',
+                                         **{'b:a': output_args['b:a']}),
+                           overwrite_output=True, capture_stdout=True, capture_stderr=True)
+                return audio
+
+            with ThreadPoolExecutor(workers) as pool:
+                audio_job = pool.submit(encode_audio) if has_audio else None
+                encoded = list(pool.map(encode, segments))
+                audio = audio_job.result() if audio_job else None
+
+            concat_list = os.path.join(tmp, 'segments.txt')
+            with open(concat_list, 'w') as f:
+                # Relative to the list, so quotes in the folder names can't break the concat demuxer
+                f.writelines(f"file '{os.path.basename(path)}'\n" for path in encoded)
+
+            streams = [ffmpeg.input(concat_list, f='concat', safe=0)['v']]
+            if audio:
+                streams.append(ffmpeg.input(audio)['a'])
+            join_args = {'c': 'copy', 'movflags': '+faststart'}
+            if has_subtitles:
+                streams.append(source['s'])
+                join_args['c:s'] = 'mov_text'
+            ffmpeg.run(ffmpeg.output(*streams, output_file, **join_args),
+                       overwrite_output=True, capture_stdout=True, capture_stderr=True)
+
+        return True
+
+    async def stream_convert_to_mp4(self, input_file, quality='original', subtitle_index=None,
+                                    chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Convert a video like convert_to_mp4, but yield the MP4 from the ffmpeg pipe as it is encoded
+        instead of writing it to disk.
+        """
+        probe = await self.media_tools.probe(input_file)
+        input_stream = ffmpeg.input(input_file)
+        remux = TelegramUploader.build_remux_args(probe, quality, subtitle_index)
+        if remux:
+            stream_indexes, output_args = remux
+            streams = [input_stream[str(index)] for index in stream_indexes]
+            subtitle_file = None
+        else:
+            output_args, subtitle_file = TelegramUploader.build_output_args(input_file, probe, quality, subtitle_index)
+            streams = [input_stream]
+        # A pipe can't be seeked back to write the moov atom, so the output is a fragmented MP4
+        output_args['movflags'] = 'frag_keyframe+empty_moov+default_base_moof'
+        output_args['format'] = 'mp4'
+        cmd = ffmpeg.output(*streams, 'pipe:', **output_args).compile()
+
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        try:
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            if await process.wait() != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if subtitle_file and os.path.exists(subtitle_file):
+                os.remove(subtitle_file)
+
+    def convert_video(self, output_file):
+        """Run one of the queued conversions. Called from the conversion pool."""
+        video, quality, subtitle_index = self.conversions[output_file]
+        try:
+            converted = self.convert_to_mp4(video, output_file, quality, subtitle_index, ask_overwrite=False,
+                                            workers=self.transcode_workers)
+        except Exception as e:
+            print(f"Failed to convert {video}: {e}")
+            return False
+        if not converted:
+            print(f"Failed to convert: {video}")
+            return False
+        print(f"Converted: {video} -> {output_file}")
+        if video in self.replaced:
+            try:
+                os.remove(video)
+                print(f"Deleted original file: {video}")
+            except Exception as e:
+                print(f"Error deleting {video}: {e}")
+        return True
+
+    def start_conversions(self, plan):
+        # Queued in posting order, so the conversion needed next is always the first to run
+        loop = asyncio.get_running_loop()
+        for kind, value in plan:
+            if kind == 'file' and value in self.conversions and value not in self.converting:
+                self.converting[value] = loop.run_in_executor(self.conversion_pool, self.convert_video, value)
+
+    async def wait_for_conversion(self, file_path):
+        """
+        Wait for the conversion that produces or replaces file_path.
+        Returns True if the file is still to be posted afterwards.
+        """
+        if file_path in self.replaced:
+            return not await self.converting[self.replaced[file_path]]
+        return await self.converting[file_path]
+
     @staticmethod
     def ask_keep_original(file_path, keep_all=None, remove_all=None):
         if keep_all is not None:
@@ -283,17 +908,68 @@ class TelegramUploader:
             else:
                 print("Invalid input. Please enter 'y' for yes, 'n' for no, 'ya' for yes to all, or 'na' for no to all.")
 
-    async def upload_file_fast(self, file_path, progress_callback):
-        with open(file_path, 'rb') as file:
-            return await upload_file(self.client, file, progress_callback=progress_callback)
+    async def upload_file_fast(self, file_path, progress_callback, volume=None, session=None):
+        # A volume is a tuple of (offset, size, name) and is read from the file by offset
+        session = session or self.sessions[0]
+        offset, size = volume[:2] if volume else (0, os.path.getsize(file_path))
+        if self.upload_processes and size >= SHARDED_UPLOAD_MIN_SIZE:
+            # Sharded uploads are not journaled, an interrupted one starts over
+            return await upload_file_sharded(session.client, file_path, progress_callback,
+                                             processes=self.upload_processes,
+                                             pipeline_depth=UPLOAD_PIPELINE_DEPTH, offset=offset, size=size,
+                                             pool=session.sender_pool)
+        with FileSlice(file_path, *volume) if volume else open(file_path, 'rb') as file:
+            # The journal holds file ids of the primary account only
+            return await upload_file(session.client, file, progress_callback=progress_callback,
+                                     read_ahead=READ_AHEAD_PARTS, memory_budget=READ_AHEAD_MEMORY,
+                                     pipeline_depth=UPLOAD_PIPELINE_DEPTH, pool=session.sender_pool,
+                                     tuning=self.tuning,
+                                     journal=self.journal if session.primary else None)
+
+    def pick_session(self):
+        # The session with the fewest uploads in flight, the primary one on a tie
+        return min(self.sessions, key=lambda session: (session.uploading, not session.primary))
+
+    async def start_helper_sessions(self):
+        """Log in the helper sessions and check every session can reach the staging chat. Returns False if one fails."""
+        for session in self.sessions:
+            try:
+                if not session.primary:
+                    await session.client.start()
+                staging_chat = await session.client.get_entity(self.staging_chat)
+            except Exception as e:
+                print(f"Failed to start session {session.client.session.filename}: {e}")
+                return False
+            # Message ids are only the same for every account in channels and supergroups, private
+            # chats and basic groups number the messages of each account separately
+            if not isinstance(staging_chat, Channel):
+                print("Error: the staging chat has to be a channel or supergroup")
+                return False
+        return True
+
+    async def hand_over(self, session, file_path, media, is_video, content_hash):
+        """
+        Post a file a helper session uploaded to the staging chat and fetch that message with the
+        primary session, whose file reference lets it post the same document to the chat.
+        Returns the same tuple as prepare_upload, or None if the hand over failed.
+        """
+        message = await session.client.send_file(self.staging_chat, media,
+                                                  caption=self.remove_extension(os.path.basename(file_path)),
+                                                  supports_streaming=is_video)
+        staged = await self.client.get_messages(self.staging_chat, ids=message.id)
+        # Document ids are the same for every account, so this is the document the helper posted
+        if not staged or not staged.document or staged.document.id != message.document.id:
+            print(f'Failed to hand over {file_path}: the staged message is not visible to the primary session')
+            return None
+        return InputMediaDocument(utils.get_input_document(staged.document)), is_video, content_hash
 
-    def get_video_metadata(self, file_path):
+    async def get_video_metadata(self, file_path):
         """
         Safely extract video metadata using ffprobe/ffmpeg.
         Returns tuple of (width, height, duration) or (None, None, None) if extraction fails.
         """
         try:
-            probe = ffmpeg.probe(file_path)
+            probe = await self.media_tools.probe(file_path)
             video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
             
             if video_stream:
@@ -313,18 +989,9 @@ class TelegramUploader:
                     except:
                         duration = 0
                 elif 'duration' in probe['format']:
+                    # Filled from the packet timestamps by the probe cache when the container has none
                     duration = int(float(probe['format']['duration']))
                 
-                # Fallback for duration
-                if duration == 0:
-                    # Use ffmpeg to analyze the video duration
-                    cmd = ['ffmpeg', '-i', file_path, '-f', 'null', '-']
-                    result = subprocess.run(cmd, capture_output=True, text=True)
-                    duration_match = re.search(r'time=(\d+):(\d+):(\d+)', result.stderr)
-                    if duration_match:
-                        h, m, s = map(int, duration_match.groups())
-                        duration = h * 3600 + m * 60 + s
-                
                 return width, height, duration
             
             return None, None, None
@@ -332,7 +999,47 @@ class TelegramUploader:
         except Exception as e:
             return None, None, None
 
-    async def upload_file_with_progress(self, file_path, current_file=0, total_files=0):
+    @staticmethod
+    def hash_file(file_path, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    async def refresh_document(self, content_hash):
+        """
+        Fetch the message a deduplicated document was first sent in again, to get a fresh file
+        reference. Returns the new InputMediaDocument, or None if the message is gone.
+        """
+        found = self.manifest.find_document(content_hash)
+        if found:
+            _, chat_id, message_id = found
+            message = await self.client.get_messages(chat_id, ids=message_id)
+            if message and message.document:
+                self.manifest.record_document(content_hash, message.document, chat_id, message_id)
+                return InputMediaDocument(utils.get_input_document(message.document))
+        self.manifest.forget_document(content_hash)
+        return None
+
+    async def upload_thumbnail(self, file_path, client=None):
+        content_key = await asyncio.get_running_loop().run_in_executor(None, ProbeCache.content_key, file_path)
+        jpeg = probe_cache.thumbnail(content_key)
+        if jpeg is None:
+            jpeg = await self.create_thumbnail(file_path)
+            if not jpeg:
+                return None
+            probe_cache.store_thumbnail(content_key, jpeg)
+        return await (client or self.client).upload_file(jpeg, file_name='thumb.jpg')
+
+    async def prepare_upload(self, file_path, current_file=0, total_files=0):
+        """
+        Upload the file contents and build the media to post, without sending a message yet.
+        Returns tuple of (media, is_video, content_hash) or None if the file was skipped or failed.
+        """
+        progress_bar = None
+        metadata = thumb = None
+        session = None
         try:
             file_size = os.path.getsize(file_path)
             
@@ -342,20 +1049,37 @@ class TelegramUploader:
             elif file_size > SIZE_LIMIT_2GB:
                 print(f"Warning: {file_path} exceeds 2GB limit. Uploading may fail for non-Premium users.")
 
+            content_hash = None
+            if self.dedup:
+                content_hash = await asyncio.get_running_loop().run_in_executor(None, self.hash_file, file_path)
+                found = self.manifest.find_document(content_hash)
+                if found:
+                    print(f'Reusing the already uploaded copy of {file_path}')
+                    return InputMediaDocument(found[0]), bool(self.is_video_file(file_path)), content_hash
+
             progress_bar = tqdm(total=file_size, unit='B', unit_scale=True, 
                               desc=f'Uploading {os.path.basename(file_path)} [{current_file}/{total_files}]')
 
             def progress_callback(current, total):
                 progress_bar.update(current - progress_bar.n)
 
-            file = await self.upload_file_fast(file_path, progress_callback)
             attributes, mime_type = utils.get_attributes(file_path)
-            
+
+            # Whole files are spread over the sessions
+            session = self.pick_session()
+            session.uploading += 1
+
             # Check if file is video
             is_video = mime_type.startswith('video/')
-            
             if is_video:
-                width, height, duration = self.get_video_metadata(file_path)
+                # Probed and thumbnailed while the file uploads
+                metadata = asyncio.ensure_future(self.get_video_metadata(file_path))
+                thumb = asyncio.ensure_future(self.upload_thumbnail(file_path, session.client))
+
+            file = await self.upload_file_fast(file_path, progress_callback, session=session)
+
+            if is_video:
+                width, height, duration = await metadata
                 
                 if width and height and duration:
                     video_attribute = DocumentAttributeVideo(
@@ -385,25 +1109,289 @@ class TelegramUploader:
                 file=file,
                 mime_type=mime_type,
                 attributes=attributes,
-                thumb=await self.client.upload_file(self.create_thumbnail(file_path, 'thumb.jpg')) if is_video else None,
+                thumb=await thumb if is_video else None,
                 force_file=False
             )
+            if not session.primary:
+                return await self.hand_over(session, file_path, media, is_video, content_hash)
+            return media, is_video, content_hash
+        except Exception as e:
+            print(f'Failed to upload {file_path}: {str(e)}')
+            return None
+        finally:
+            if session:
+                session.uploading -= 1
+            for task in (metadata, thumb):
+                if task and not task.done():
+                    task.cancel()
+            if progress_bar:
+                progress_bar.close()
+
+    async def prepare_stream_upload(self, file_path, current_file=0, total_files=0):
+        """
+        Convert a video to MP4 and upload the output while ffmpeg is still producing it.
+        Returns tuple of (media, is_video, content_hash) or None if the conversion or upload failed.
+        """
+        quality, subtitle_index = self.stream_conversions[file_path]
+        progress_bar = None
+        # Probed and thumbnailed from the source while the conversion uploads
+        metadata = asyncio.ensure_future(self.get_video_metadata(file_path))
+        thumb = asyncio.ensure_future(self.upload_thumbnail(file_path))
+        try:
+            progress_bar = tqdm(total=None, unit='B', unit_scale=True,
+                                desc=f'Converting and uploading {os.path.basename(file_path)} [{current_file}/{total_files}]')
+
+            def progress_callback(current, total):
+                progress_bar.update(current - progress_bar.n)
+
+            file, _ = await upload_stream(self.client, self.stream_convert_to_mp4(file_path, quality, subtitle_index),
+                                          progress_callback=progress_callback, pipeline_depth=UPLOAD_PIPELINE_DEPTH,
+                                          pool=self.sender_pool, tuning=self.tuning)
+
+            width, height, duration = await metadata
+            if not (width and height and duration):
+                width, height, duration = 1280, 720, 0
+            if quality in ('720p', '1080p'):
+                # Same as ffmpeg's scale=-2:<height>
+                target = int(quality[:-1])
+                width, height = round(width * target / height / 2) * 2, target
+
+            attributes = [
+                DocumentAttributeVideo(w=width, h=height, duration=duration, supports_streaming=True),
+                DocumentAttributeFilename(f"{os.path.splitext(os.path.basename(file_path))[0]}.mp4"),
+            ]
+            media = InputMediaUploadedDocument(
+                file=file,
+                mime_type='video/mp4',
+                attributes=attributes,
+                thumb=await thumb,
+                force_file=False
+            )
+            return media, True, None
+        except Exception as e:
+            print(f'Failed to convert and upload {file_path}: {str(e)}')
+            return None
+        finally:
+            for task in (metadata, thumb):
+                if not task.done():
+                    task.cancel()
+            if progress_bar:
+                progress_bar.close()
+
+    @staticmethod
+    def split_video(input_file, output_dir, max_size):
+        """
+        Cut a video into stream copied MP4 parts of at most max_size bytes. The cuts are at keyframes,
+        so every part plays on its own. Returns the part paths in order, or None if no segment
+        length brings every part under max_size.
+        """
+        probe = probe_cache.probe(input_file)
+        duration = float(probe['format'].get('duration', 0))
+        if not duration:
+            return None
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        # Keyframes don't fall exactly on the segment length, so aim below the limit
+        segment_time = duration * max_size / os.path.getsize(input_file) * 0.9
+        source = ffmpeg.input(input_file)
+        for _ in range(SPLIT_ATTEMPTS):
+            for old_part in os.listdir(output_dir):
+                os.remove(os.path.join(output_dir, old_part))
+            ffmpeg.run(ffmpeg.output(source['v:0'], source['a?'], os.path.join(output_dir, f'{name}.part%03d.mp4'),
+                                     c='copy', f='segment', segment_time=f'{segment_time:.3f}', reset_timestamps=1,
+                                     segment_start_number=1, segment_format='mp4',
+                                     segment_format_options='movflags=+faststart'),
+                       overwrite_output=True, capture_stdout=True, capture_stderr=True)
+            parts = sorted(os.path.join(output_dir, part) for part in os.listdir(output_dir))
+            if all(os.path.getsize(part) <= max_size for part in parts):
+                return parts
+            segment_time *= 0.75
+        return None
+
+    async def prepare_volume(self, file_path, offset, size, name, progress_callback=None):
+        """
+        Upload a byte range of a file as a document of its own.
+        Returns the same tuple as prepare_upload.
+        """
+        file = await self.upload_file_fast(file_path, progress_callback,
+                                           volume=(offset, size, os.path.join(os.path.dirname(file_path), name)))
+        media = InputMediaUploadedDocument(
+            file=file,
+            mime_type='application/octet-stream',
+            attributes=[DocumentAttributeFilename(name)],
+            force_file=True
+        )
+        return media, False, None
+
+    async def prepare_split(self, file_path, current_file=0, total_files=0):
+        """
+        Upload a file over the split size in parts: videos as keyframe aligned MP4 parts that play on
+        their own, everything else as byte range volumes name.001, name.002, ...
+        Returns tuple of (parts, note, temp_dir) where parts is a list of (caption, part_path, prepared)
+        and note the message explaining how to join them, or None if the upload failed.
+        """
+        name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        temp_dir = None
+        if self.is_video_file(file_path):
+            temp_dir = tempfile.mkdtemp(prefix=SPLIT_TEMP_PREFIX, dir=os.path.dirname(os.path.abspath(file_path)))
+            try:
+                print(f'Cutting {file_path} into parts')
+                video_parts = await asyncio.get_running_loop().run_in_executor(
+                    None, self.split_video, file_path, temp_dir, self.split_size)
+            except ffmpeg.Error as e:
+                print(f'Failed to cut {file_path} at keyframes: {e.stderr.decode(errors="replace")[-200:]}')
+                video_parts = None
+            if video_parts:
+                parts = []
+                for part in video_parts:
+                    prepared = await self.prepare_upload(part, current_file, total_files)
+                    if prepared is None:
+                        shutil.rmtree(temp_dir, ignore_errors=True)
+                        return None
+                    parts.append((self.remove_extension(os.path.basename(part)), part, prepared))
+                part_names = [os.path.basename(part) for part in video_parts]
+                note = (f"#split {name} ({file_size} bytes) was uploaded in {len(parts)} parts:\n"
+                        + "\n".join(part_names)
+                        + "\n\nEach part plays on its own. To join them, list the parts in parts.txt as"
+                        + f" file 'name' lines and run:\nffmpeg -f concat -safe 0 -i parts.txt -c copy"
+                          f" \"{self.remove_extension(name)}.mp4\"")
+                return parts, note, temp_dir
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            temp_dir = None
 
+        count = -(-file_size // self.split_size)
+        width = max(3, len(str(count)))
+        parts = []
+        progress_bar = tqdm(total=file_size, unit='B', unit_scale=True,
+                            desc=f'Uploading {name} in {count} parts [{current_file}/{total_files}]')
+        try:
+            for index in range(count):
+                offset = index * self.split_size
+                volume_name = f'{name}.{index + 1:0{width}d}'
+
+                def progress_callback(current, total):
+                    progress_bar.update(offset + current - progress_bar.n)
+
+                prepared = await self.prepare_volume(file_path, offset, min(self.split_size, file_size - offset),
+                                                     volume_name, progress_callback)
+                parts.append((volume_name, os.path.join(os.path.dirname(file_path), volume_name), prepared))
+        except Exception as e:
+            print(f'Failed to upload {file_path}: {str(e)}')
+            return None
+        finally:
+            progress_bar.close()
+        volume_names = [volume_name for volume_name, _, _ in parts]
+        windows_volumes = '+'.join(f'"{volume_name}"' for volume_name in volume_names)
+        note = (f"#split {name} ({file_size} bytes) was uploaded in {count} parts:\n"
+                + "\n".join(volume_names)
+                + f"\n\nJoin them with:\ncat \"{name}\".* > \"{name}\"  (Linux, macOS)\n"
+                + f"copy /b {windows_volumes} \"{name}\"  (Windows)")
+        return parts, note, None
+
+    async def post_split(self, file_path, split):
+        """Post the parts of a split file and the note on joining them. Returns the note message."""
+        parts, note, temp_dir = split
+        try:
+            for caption, part_path, prepared in parts:
+                # The parts can't be uploaded again on their own, so expired parts are not retried
+                if not await self.send_prepared(part_path, prepared, retry_expired=False, caption=caption):
+                    print(f'Failed to post all parts of {file_path}')
+                    return None
+            message = await self.client.send_message(CHAT_ID, note)
+            print(f'Successfully uploaded {file_path} in {len(parts)} parts')
+            return message
+        except Exception as e:
+            print(f'Failed to post the parts of {file_path}: {str(e)}')
+            return None
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def send_prepared(self, file_path, prepared, retry_expired=True, caption=None):
+        media, is_video, content_hash = prepared
+        try:
             message = await self.client.send_file(
                 CHAT_ID,
                 media,
-                caption=self.remove_extension(os.path.basename(file_path)),
+                caption=caption or self.remove_extension(os.path.basename(file_path)),
                 supports_streaming=is_video
             )
 
-            progress_bar.close()
+            self.journal.forget(os.path.abspath(file_path))
+            if content_hash and message.document:
+                self.manifest.record_document(content_hash, message.document, CHAT_ID, message.id)
             print(f'Successfully uploaded: {file_path}')
             return message
+        except (FilePartMissingError, FilePartsInvalidError) as e:
+            # Telegram already dropped some of the parts of a resumed upload
+            self.journal.forget(os.path.abspath(file_path))
+            if not retry_expired:
+                print(f'Failed to upload {file_path}: {str(e)}')
+                return None
+            print(f'Uploaded parts of {file_path} expired, uploading it again')
+            return await self.upload_file_with_progress(file_path, retry_expired=False)
+        except (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError) as e:
+            # Only deduplicated documents are sent by reference
+            if not isinstance(media, InputMediaDocument) or not retry_expired:
+                print(f'Failed to upload {file_path}: {str(e)}')
+                return None
+            media = await self.refresh_document(content_hash)
+            if media is None:
+                print(f'Original message of {file_path} is gone, uploading it again')
+                return await self.upload_file_with_progress(file_path, retry_expired=False)
+            return await self.send_prepared(file_path, (media, is_video, content_hash), retry_expired=False)
         except Exception as e:
-            progress_bar.close()
             print(f'Failed to upload {file_path}: {str(e)}')
             return None
 
+    @staticmethod
+    def album_kind(file_path, is_video):
+        """
+        Files only share an album with files of the same kind. Returns the kind, or None for files
+        that are always posted alone.
+        """
+        mime_type = mimetypes.guess_type(file_path)[0] or ''
+        if mime_type == 'image/gif':
+            # Sent as an animation, which albums can't hold
+            return None
+        if is_video:
+            return 'media'
+        if mime_type.startswith('audio/'):
+            return 'audio'
+        return 'document'
+
+    async def send_album(self, album):
+        """
+        Post prepared files as one album, keeping their order and captions.
+        Returns the messages in album order, None for files that failed.
+        """
+        if len(album) == 1:
+            return [await self.send_prepared(*album[0])]
+        try:
+            messages = await self.client.send_file(
+                CHAT_ID,
+                [media for _, (media, _, _) in album],
+                caption=[self.remove_extension(os.path.basename(file_path)) for file_path, _ in album],
+                supports_streaming=any(is_video for _, (_, is_video, _) in album)
+            )
+        except Exception as e:
+            # send_prepared knows how to recover from expired parts and file references
+            print(f'Failed to post an album: {str(e)}, posting its files one by one')
+            return [await self.send_prepared(file_path, prepared) for file_path, prepared in album]
+
+        for (file_path, (media, is_video, content_hash)), message in zip(album, messages):
+            self.journal.forget(os.path.abspath(file_path))
+            if content_hash and message.document:
+                self.manifest.record_document(content_hash, message.document, CHAT_ID, message.id)
+            print(f'Successfully uploaded: {file_path}')
+        return messages
+
+    async def upload_file_with_progress(self, file_path, current_file=0, total_files=0, retry_expired=True):
+        prepared = await self.prepare_upload(file_path, current_file, total_files)
+        if prepared is None:
+            return None
+        return await self.send_prepared(file_path, prepared, retry_expired)
+
     async def send_message(self, message, bold=False):
         try:
             if bold:
@@ -412,44 +1400,163 @@ class TelegramUploader:
         except Exception as e:
             print(f'Failed to send message: {e}')
 
-    async def process_directory(self, dir_path, relative_path, total_files, current_file=0):
+    def file_stat(self, file_path):
+        """Returns tuple of (size, mtime_ns), from the folder index unless a conversion wrote the file."""
+        entry = self.index.files.get(file_path)
+        if entry and file_path not in self.converting:
+            return entry.size, entry.mtime_ns
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def manifest_key(self, file_path):
+        # Relative to the parent of the uploaded folder, so the folder name is part of the key
+        rel_path = os.path.relpath(file_path, os.path.dirname(os.path.abspath(self.root_folder)))
+        return rel_path.replace(os.sep, '/')
+
+    def build_upload_plan(self, dir_path, relative_path, plan=None):
+        """
+        List everything process_directory posts, in posting order.
+        Entries are ('header', relative_path) or ('file', file_path).
+        """
+        if plan is None:
+            plan = []
         if relative_path:
-            await self.send_message(relative_path, bold=False)
+            plan.append(('header', relative_path))
 
-        items = os.listdir(dir_path)
-        files = [f for f in items if os.path.isfile(os.path.join(dir_path, f))]
-        dirs = [d for d in items if os.path.isdir(os.path.join(dir_path, d))]
+        directory = self.index.directories[dir_path]
+        files = [os.path.basename(entry.path) for entry in directory.files]
+        dirs = [os.path.basename(subdir_path) for subdir_path in directory.dirs]
         
+        # MP4s that are still to be converted are posted where they will appear in the folder
+        files += [os.path.basename(output_file) for output_file in self.conversions
+                  if os.path.dirname(output_file) == dir_path and not os.path.exists(output_file)]
         files.sort(key=self.natural_sort_key)
         dirs.sort(key=self.natural_sort_key)
 
         for file in files:
-            if file != 'thumb.jpg':
-                file_path = os.path.join(dir_path, file)
-                if file_path not in self.uploaded_files:
-                    print(f'Processing: {file_path}')
-                    
-                    current_file += 1
-                    message = await self.upload_file_with_progress(file_path, current_file, total_files)
-
-                    if message:
-                        self.uploaded_files.add(file_path)
-                else:
-                    print(f'Skipping already uploaded file: {file_path}')
-                    current_file += 1
+            plan.append(('file', os.path.join(dir_path, file)))
 
         for dir_name in dirs:
             subdir_path = os.path.join(dir_path, dir_name)
             subdir_relative_path = os.path.join(relative_path, dir_name) if relative_path else dir_name
-            current_file = await self.process_directory(subdir_path, subdir_relative_path, total_files, current_file)
+            self.build_upload_plan(subdir_path, subdir_relative_path, plan)
+
+        return plan
+
+    async def process_directory(self, dir_path, relative_path, total_files, current_file=0, root_message=None):
+        # Up to parallel_files uploads per session run at the same time, sharing the connection budget
+        # of their session, while messages are still posted strictly in plan order. A file waiting for
+        # its conversion holds no upload slot, so the files after it keep uploading meanwhile, up to
+        # UNPOSTED_FILES ahead of the message that is posted next.
+        upload_slots = asyncio.Semaphore(self.parallel_files * len(self.sessions))
+        plan = self.build_upload_plan(dir_path, relative_path)
+        self.start_conversions(plan)
+        plan = iter(plan)
+        window = deque()
+        unposted = 0
+
+        async def prepare(file_path, number, pending):
+            # Returns tuple of (kind, prepared), kind is 'split' for a file uploaded in parts
+            if pending and not await self.wait_for_conversion(file_path):
+                return 'file', None
+            async with upload_slots:
+                # Checked after the conversion, its MP4 can be over the split size as well
+                if self.file_stat(file_path)[0] > self.split_size:
+                    return 'split', await self.prepare_split(file_path, number, total_files)
+                if file_path in self.stream_conversions:
+                    return 'file', await self.prepare_stream_upload(file_path, number, total_files)
+                return 'file', await self.prepare_upload(file_path, number, total_files)
+
+        def fill_window():
+            nonlocal current_file, unposted
+            while unposted < UNPOSTED_FILES:
+                entry = next(plan, None)
+                if entry is None:
+                    return
+                kind, value = entry
+                if kind == 'file':
+                    current_file += 1
+                    # Files a conversion is still writing or deleting are checked once it is done
+                    pending = value in self.converting or value in self.replaced
+                    if not pending:
+                        size, mtime_ns = self.file_stat(value)
+                        if self.manifest.is_uploaded(self.manifest_key(value), size, mtime_ns):
+                            print(f'Skipping already uploaded file: {value}')
+                            continue
+                    print(f'Processing: {value}')
+                    window.append((kind, value, asyncio.ensure_future(prepare(value, current_file, pending))))
+                    unposted += 1
+                else:
+                    window.append((kind, value, None))
+
+        # Consecutive files of one kind from the same directory, posted together once complete
+        album = []
+        album_key = None
+
+        def record(file_path, prepared, message):
+            if message:
+                size, mtime_ns = self.file_stat(file_path)
+                self.manifest.record(self.manifest_key(file_path), size, mtime_ns, message.id, prepared[2])
+
+        # The bold root message and the folder headers wait for the first file posted under them, so a
+        # rerun that skips most files doesn't post them again for every unchanged folder
+        headers = [(root_message, True)] if root_message else []
+
+        async def post_headers():
+            for message, bold in headers:
+                await self.send_message(message, bold=bold)
+            headers.clear()
+
+        async def post_album():
+            if album:
+                await post_headers()
+                for (file_path, prepared), message in zip(album, await self.send_album(album)):
+                    record(file_path, prepared, message)
+                album.clear()
+
+        fill_window()
+        while window:
+            kind, value, task = window.popleft()
+            if kind == 'header':
+                await post_album()
+                # A folder without new files of its own is left out, the headers hold the whole path
+                headers[:] = [header for header in headers if header[1]] + [(value, False)]
+                continue
+            unposted -= 1
+            fill_window()
+            kind, prepared = await task
+            if not prepared:
+                continue
+            if kind == 'split':
+                await post_album()
+                await post_headers()
+                message = await self.post_split(value, prepared)
+                if message:
+                    size, mtime_ns = self.file_stat(value)
+                    self.manifest.record(self.manifest_key(value), size, mtime_ns, message.id)
+                continue
+            if self.albums:
+                album_kind = self.album_kind(value, prepared[1])
+                if album and album_key != (os.path.dirname(value), album_kind):
+                    await post_album()
+                if album_kind:
+                    album.append((value, prepared))
+                    album_key = (os.path.dirname(value), album_kind)
+                    if len(album) == ALBUM_SIZE:
+                        await post_album()
+                    continue
+            await post_headers()
+            record(value, prepared, await self.send_prepared(value, prepared))
+        await post_album()
 
         return current_file
 
     @staticmethod
-    def count_files(directory):
-        return sum(len(files) for _, _, files in os.walk(directory))
+    def count_files(index):
+        return len(index.files)
 
-    async def upload_files(self, file_folder):
+    async def authorize(self):
+        """Log in on first use and resolve the chat. Returns False if either fails."""
         if not await self.client.is_user_authorized():
             print("First time authentication required.")
             phone = input("Please enter your phone number (with country code): ")
@@ -457,17 +1564,32 @@ class TelegramUploader:
             print("New session created. You may need to enter the code you received.")
             if not await self.client.is_user_authorized():
                 print("Authentication failed. Please run the script again.")
-                return
+                return False
 
         try:
             await self.client.get_entity(CHAT_ID)
         except Exception as e:
             print(f"Failed to resolve the chat ID: {e}")
+            return False
+        return True
+
+    async def upload_files(self, file_folder):
+        if not await self.authorize():
             return
 
-        non_streamable_videos, files_exceeding_2gb, files_exceeding_4gb = self.check_file_issues(file_folder)
+        print(f"Indexing {file_folder}...")
+        self.index = FolderIndex.scan(file_folder)
+        removed = []
+        left_out = []  # Kept on disk but not uploaded
+        non_streamable_videos, files_exceeding_2gb, files_exceeding_4gb = self.check_file_issues(self.index)
 
-        if non_streamable_videos or files_exceeding_2gb or files_exceeding_4gb:
+        # Files over the split size are uploaded in parts instead
+        files_to_split = [file for file in files_exceeding_2gb + files_exceeding_4gb
+                          if self.index.files[file].size > self.split_size]
+        files_exceeding_2gb = [file for file in files_exceeding_2gb if file not in files_to_split]
+        files_exceeding_4gb = [file for file in files_exceeding_4gb if file not in files_to_split]
+
+        if non_streamable_videos or files_exceeding_2gb or files_exceeding_4gb or files_to_split:
             print("Warning: The following issues were found:")
             
             if non_streamable_videos:
@@ -476,9 +1598,23 @@ class TelegramUploader:
                     print(f"- {video}")
                 
                 convert = input("\nDo you want to convert these videos to MP4 format? (y/n): ").lower()
-                if convert == 'y':
+                if convert == 'y' and self.stream_convert:
+                    quality = self.choose_quality()
+                    # The originals stay on disk, only the converted output is uploaded. Parts are cut
+                    # from a file, so a video over the split size is converted to an MP4 on disk first.
+                    for video in non_streamable_videos:
+                        subtitle_index = self.choose_subtitle(video)
+                        if self.index.files[video].size <= self.split_size:
+                            self.stream_conversions[video] = (quality, subtitle_index)
+                            continue
+                        left_out.append(video)
+                        output_file = f"{os.path.splitext(video)[0]}.mp4"
+                        if self.resolve_existing_output(video, output_file):
+                            print(f"Queued for conversion, too large to stream: {video} -> {output_file}")
+                            self.conversions[output_file] = (video, quality, subtitle_index)
+                    non_streamable_videos = []
+                elif convert == 'y':
                     quality = self.choose_quality()
-                    print("\nConverting non-MP4 videos to MP4 format...")
                     keep_all = None
                     remove_all = None
                     
@@ -491,27 +1627,27 @@ class TelegramUploader:
                     elif not response:  # Single 'no' response
                         remove_all = True
                     
-                    # Then process all files
+                    # Then queue all files, they are converted by the conversion pool while the
+                    # upload runs and each one is posted as soon as it is converted
                     for video in non_streamable_videos:
                         output_file = f"{os.path.splitext(video)[0]}.mp4"
-                        print(f"Converting: {video} -> {output_file}")
-                        
                         subtitle_index = self.choose_subtitle(video)
-                        
-                        if self.convert_to_mp4(video, output_file, quality, subtitle_index):
-                            print(f"Converted: {video} -> {output_file}")
-                            # Delete original file if remove_all is True
+
+                        if not self.resolve_existing_output(video, output_file):
+                            # Keep the existing output, same as a finished conversion
                             if remove_all:
                                 try:
                                     os.remove(video)
+                                    removed.append(video)
                                     print(f"Deleted original file: {video}")
                                 except Exception as e:
                                     print(f"Error deleting {video}: {e}")
-                        else:
-                            print(f"Failed to convert: {video}")
-                    
-                    # Recheck for file issues after conversion
-                    non_streamable_videos, files_exceeding_2gb, files_exceeding_4gb = self.check_file_issues(file_folder)
+                            continue
+
+                        print(f"Queued for conversion: {video} -> {output_file}")
+                        self.conversions[output_file] = (video, quality, subtitle_index)
+                        if remove_all:
+                            self.replaced[video] = output_file
             
             if files_exceeding_2gb:
                 print("\nFiles exceeding 2GB (may fail for non-Premium users):")
@@ -522,18 +1658,190 @@ class TelegramUploader:
                 print("\nFiles exceeding 4GB (will be skipped):")
                 for file in files_exceeding_4gb:
                     print(f"- {file}")
+
+            if files_to_split:
+                print(f"\nFiles larger than {self.split_size // (1024 * 1024)}MB (will be uploaded in parts):")
+                for file in files_to_split:
+                    print(f"- {file}")
             
             proceed = input("\nDo you want to proceed with the upload? (y/n): ").lower()
             if proceed != 'y':
                 print("Upload cancelled.")
                 return
 
-        await self.send_message(os.path.basename(file_folder), bold=True)
+        if len(self.sessions) > 1 and not await self.start_helper_sessions():
+            return
+
+        self.root_folder = file_folder
+        self.index = self.index.without(removed + left_out)
+        self.manifest = UploadManifest(MANIFEST_FILE, CHAT_ID)
 
-        total_files = self.count_files(file_folder)
+        total_files = self.count_files(self.index) + sum(not os.path.exists(f) for f in self.conversions)
         print(f"Total files to upload: {total_files}")
         
-        await self.process_directory(file_folder, "", total_files)
+        try:
+            await self.process_directory(file_folder, "", total_files,
+                                         root_message=os.path.basename(file_folder))
+        finally:
+            # shutdown(cancel_futures=True) needs Python 3.9, so drop the queued conversions by hand.
+            for future in self.converting.values():
+                future.cancel()
+            self.conversion_pool.shutdown(wait=False)
+            probe_cache.close()
+            await self.sender_pool.close()
+            for session in self.sessions[1:]:
+                await session.sender_pool.close()
+                await session.client.disconnect()
+            self.manifest.close()
+
+    @staticmethod
+    def parse_posted_message(message):
+        """
+        Tell what an uploaded message is: the bold folder name posted first, the relative path
+        posted before the files of every subfolder, or a file. Only folder names and paths this
+        account posted are used, notes on joining split files and other messages are ignored.
+        Returns tuple of ('root', folder_name), ('header', relative_path) or ('file', None), or None.
+        """
+        if message.file and not message.web_preview:
+            return 'file', None
+        text = message.message or ''
+        # Comments of other members, or longer texts, would otherwise move the following files into a new folder
+        if not message.out or not text or message.media or '\n' in text or text.startswith('#split '):
+            return None
+        if any(isinstance(entity, MessageEntityBold) and entity.offset == 0 and entity.length >= len(text)
+               for entity in message.entities or ()):
+            return 'root', text
+        return 'header', text
+
+    @staticmethod
+    def safe_relative_path(path):
+        # Headers posted from Windows use backslashes, and nothing may point outside the download folder
+        parts = [part for part in re.split(r'[\\/]', path) if part not in ('', '.', '..')]
+        return os.path.join(*parts) if parts else ''
+
+    @staticmethod
+    def file_sha256(file_path):
+        hash_sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hash_sha256.update(chunk)
+        return hash_sha256.hexdigest()
+
+    async def download_message(self, message, file_path, ledger, retry_expired=True):
+        """
+        Download the file of a message, or only the parts an interrupted download is missing.
+        Returns True once the file is complete on disk.
+        """
+        loop = asyncio.get_running_loop()
+        size = message.file.size
+        entry = ledger.status(message.id)
+        if entry and entry[4] and os.path.exists(file_path):
+            stat = os.stat(file_path)
+            # Files touched since they were downloaded are hashed again before they are trusted
+            if stat.st_size == size and (stat.st_mtime_ns == entry[3]
+                                         or await loop.run_in_executor(None, self.file_sha256, file_path) == entry[4]):
+                print(f'Skipping already downloaded file: {file_path}')
+                return True
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        progress_bar = tqdm(total=size, unit='B', unit_scale=True, desc=f'Downloading {os.path.basename(file_path)}')
+
+        def progress_callback(current, total):
+            progress_bar.update(current - progress_bar.n)
+
+        try:
+            if message.document:
+                part_size_kb = utils.get_appropriated_part_size(size)
+                written = set()
+                if (entry and not entry[4] and entry[2] == part_size_kb * 1024 and os.path.exists(file_path)
+                        and os.path.getsize(file_path) == size):
+                    written = ledger.written_parts(message.id)
+                    print(f'Resuming download of {file_path} with {len(written)} parts already written')
+                else:
+                    ledger.start(message.id, file_path, size, part_size_kb * 1024)
+                with open(file_path, 'r+b' if written else 'wb') as f:
+                    await download_file(self.client, message.document, f, progress_callback, pool=self.sender_pool,
+                                        part_size_kb=part_size_kb, skip=written,
+                                        on_part_written=lambda part: ledger.part_written(message.id, part))
+            else:
+                # Photos are small and come in a single request
+                await self.client.download_media(message, file_path, progress_callback=progress_callback)
+        except FileReferenceExpiredError:
+            if not retry_expired:
+                raise
+            # File references of messages fetched long ago expire, the message is fetched again
+            message = await self.client.get_messages(CHAT_ID, ids=message.id)
+            return await self.download_message(message, file_path, ledger, retry_expired=False)
+        finally:
+            progress_bar.close()
+
+        sha256 = await loop.run_in_executor(None, self.file_sha256, file_path)
+        ledger.complete(message.id, file_path, size, os.stat(file_path).st_mtime_ns, sha256)
+        print(f'Successfully downloaded: {file_path}')
+        return True
+
+    async def download_files(self, output_folder):
+        """
+        Download the files of the chat into output_folder, rebuilding the folders from the messages
+        posted by upload_files. Up to parallel_files files download at the same time, sharing the
+        connection budget.
+        """
+        if not await self.authorize():
+            return
+
+        os.makedirs(output_folder, exist_ok=True)
+        ledger = DownloadLedger(os.path.join(output_folder, DOWNLOAD_LEDGER_FILE), CHAT_ID)
+        slots = asyncio.Semaphore(self.parallel_files)
+        root = current_dir = output_folder
+        claimed = set()
+        tasks = []
+
+        async def download(message, file_path):
+            try:
+                return await self.download_message(message, file_path, ledger)
+            except Exception as e:
+                print(f'Failed to download {file_path}: {str(e)}')
+                return False
+            finally:
+                slots.release()
+
+        try:
+            async for message in self.client.iter_messages(CHAT_ID, reverse=True):
+                posted = self.parse_posted_message(message)
+                if posted is None:
+                    continue
+                kind, value = posted
+                if kind == 'root':
+                    root = current_dir = os.path.join(output_folder, self.safe_relative_path(value))
+                    continue
+                if kind == 'header':
+                    current_dir = os.path.join(root, self.safe_relative_path(value))
+                    continue
+
+                entry = ledger.status(message.id)
+                if entry:
+                    # Keeps the path an earlier run picked, even if a name was taken twice
+                    file_path = entry[0]
+                else:
+                    name = os.path.basename(self.safe_relative_path(message.file.name or '')) \
+                        or f'{message.id}{message.file.ext or ""}'
+                    file_path = os.path.join(current_dir, name)
+                    if file_path in claimed:
+                        base, ext = os.path.splitext(file_path)
+                        file_path = f'{base} ({message.id}){ext}'
+                claimed.add(file_path)
+                # Messages are only listed as fast as files finish, so file references stay fresh
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(download(message, file_path)))
+
+            results = await asyncio.gather(*tasks)
+            print(f"Downloaded {sum(results)} of {len(results)} files to {output_folder}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.sender_pool.close()
+            ledger.close()
 
 def signal_handler(sig, frame):
     print('Stopping the process gracefully...')
@@ -551,10 +1859,55 @@ if __name__ == "__main__":
     upload_parser = subparsers.add_parser('upload', help='Upload files to a specific chat')
     upload_parser.add_argument("folder", help="Path to the folder containing files to upload")
     upload_parser.add_argument("--chat-id", type=int, help="The Telegram chat ID to upload the files to")
+    upload_parser.add_argument("--parallel-files", type=int, default=PARALLEL_FILES,
+                               help="Number of files uploaded at the same time")
+    upload_parser.add_argument("--connections", type=int, default=CONNECTION_BUDGET,
+                               help="Total connections shared by all files in flight, small files are served first")
+    upload_parser.add_argument("--no-adaptive", action="store_true",
+                               help="Use fixed connection counts and part sizes instead of tuning them to the link")
+    upload_parser.add_argument("--dedup", action="store_true",
+                               help="Hash every file and post identical files by reference instead of uploading them again")
+    upload_parser.add_argument("--conversion-workers", type=int, default=CONVERSION_WORKERS,
+                               help="Number of videos converted to MP4 at the same time while other files upload")
+    upload_parser.add_argument("--transcode-workers", type=int, default=TRANSCODE_WORKERS,
+                               help="Split each converted video at keyframes and encode the segments in this many ffmpeg processes")
+    upload_parser.add_argument("--upload-processes", type=int, default=UPLOAD_PROCESSES,
+                               help="Send the parts of every file of 256MB or more from this many worker processes, to use more CPU cores")
+    upload_parser.add_argument("--sessions", nargs='+', default=[],
+                               help="Session files of other accounts that upload files next to this one")
+    upload_parser.add_argument("--staging-chat", type=int,
+                               help="Chat ID all sessions can read, where --sessions post their uploads for this session to send on")
+    upload_parser.add_argument("--albums", action="store_true",
+                               help="Post up to 10 consecutive files of the same kind from one folder as an album")
+    upload_parser.add_argument("--split-size", type=int, default=SPLIT_SIZE // (1024 * 1024),
+                               help="Upload files larger than this many MB in parts, at most 4000, use 2000 for non-Premium accounts")
+    upload_parser.add_argument("--stream-convert", action="store_true",
+                               help="Upload converted videos while they are being encoded instead of writing them to disk first")
+
+    # Download command
+    download_parser = subparsers.add_parser('download', help='Download the files of a chat into a folder')
+    download_parser.add_argument("folder", help="Path to the folder the files are downloaded to")
+    download_parser.add_argument("--chat-id", type=int, help="The Telegram chat ID to download the files from")
+    download_parser.add_argument("--parallel-files", type=int, default=PARALLEL_FILES,
+                                 help="Number of files downloaded at the same time")
+    download_parser.add_argument("--connections", type=int, default=CONNECTION_BUDGET,
+                                 help="Total connections shared by all files in flight, small files are served first")
 
     args = parser.parse_args()
 
-    uploader = TelegramUploader()
+    if args.command == 'upload':
+        uploader = TelegramUploader(parallel_files=args.parallel_files, connection_budget=args.connections,
+                                    adaptive=not args.no_adaptive, dedup=args.dedup,
+                                    stream_convert=args.stream_convert,
+                                    conversion_workers=args.conversion_workers,
+                                    transcode_workers=args.transcode_workers, albums=args.albums,
+                                    split_size=args.split_size * 1024 * 1024,
+                                    upload_processes=args.upload_processes, helper_sessions=args.sessions,
+                                    staging_chat=args.staging_chat)
+    elif args.command == 'download':
+        uploader = TelegramUploader(parallel_files=args.parallel_files, connection_budget=args.connections)
+    else:
+        uploader = TelegramUploader()
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
@@ -565,7 +1918,13 @@ if __name__ == "__main__":
             if not os.path.isdir(args.folder):
                 print(f"Error: {args.folder} is not a valid directory")
                 sys.exit(1)
+            if args.sessions and args.staging_chat is None:
+                print("Error: --sessions needs a --staging-chat")
+                sys.exit(1)
             CHAT_ID = args.chat_id
             uploader.client.loop.run_until_complete(uploader.upload_files(args.folder))
+        elif args.command == 'download':
+            CHAT_ID = args.chat_id
+            uploader.client.loop.run_until_complete(uploader.download_files(args.folder))
         else:
             parser.print_help()
\ No newline at end of file
@@ -0,0 +1,77 @@
+# Compares the old 1 KiB stream_file read loop with PartReader on a local file.
+#
+#   python benchmarks/bench_read_path.py [size_mb] [part_size_kb]
+#
+# Reports read throughput and payload allocations per GiB. "Payload allocations" counts the
+# objects holding file data that each path creates: every read() result, every slice and every
+# bytes() copy handed to the uploader.
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from FastTelethon import PartReader, stream_file  # noqa: E402
+
+GIB = 1024 * 1024 * 1024
+
+
+def legacy_path(file, part_size):
+    allocations = 0
+    buffer = bytearray()
+    for data in stream_file(file):
+        allocations += 1
+        if len(buffer) == 0 and len(data) == part_size:
+            continue
+        new_len = len(buffer) + len(data)
+        if new_len >= part_size:
+            cutoff = part_size - len(buffer)
+            buffer.extend(data[:cutoff])
+            bytes(buffer)
+            buffer.clear()
+            buffer.extend(data[cutoff:])
+            allocations += 3
+        else:
+            buffer.extend(data)
+    if len(buffer) > 0:
+        bytes(buffer)
+        allocations += 1
+    return allocations
+
+
+def part_reader_path(file, part_size):
+    allocations = 0
+    for part in PartReader(file, part_size):
+        # UploadSender.next takes exactly one copy of every part
+        bytes(part)
+        allocations += 1
+    return allocations
+
+
+def run(name, func, path, size, part_size):
+    with open(path, "rb") as file:
+        start = time.perf_counter()
+        allocations = func(file, part_size)
+        elapsed = time.perf_counter() - start
+    print(f"{name:<12} {size / elapsed / 1024 / 1024:10.1f} MiB/s"
+          f" {allocations * GIB / size:12.0f} allocations/GiB")
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+    part_size = int(sys.argv[2] if len(sys.argv) > 2 else 512) * 1024
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(size // len(chunk)):
+            tmp.write(chunk)
+    try:
+        print(f"{size // 1024 // 1024} MiB file, {part_size // 1024} KiB parts")
+        run("stream_file", legacy_path, tmp.name, size, part_size)
+        run("PartReader", part_reader_path, tmp.name, size, part_size)
+    finally:
+        os.remove(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Compares the wall time of convert_to_mp4 in a single ffmpeg process with the segmented path
+# that encodes keyframe-aligned segments in parallel.
+#
+#   python benchmarks/bench_transcode.py [seconds] [workers] [quality] [input]
+#
+# Without an input file a 720p H.264/AAC test video of the given length is generated with
+# ffmpeg's lavfi sources. Needs ffmpeg and ffprobe on the PATH.
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Telegram_Fast_Uploader import TelegramUploader  # noqa: E402
+
+
+def make_sample(path, seconds):
+    subprocess.run(["ffmpeg", "-y", "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30",
+                    "-f", "lavfi", "-i", "sine=frequency=440", "-t", str(seconds),
+                    "-c:v", "libx264", "-g", "60", "-c:a", "aac", path],
+                   check=True, capture_output=True)
+
+
+def duration(path):
+    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                             "-of", "default=nw=1:nk=1", path], check=True, capture_output=True, text=True)
+    return float(result.stdout)
+
+
+def run(name, source, output, quality, workers):
+    start = time.perf_counter()
+    converted = TelegramUploader.convert_to_mp4(source, output, quality, ask_overwrite=False, workers=workers)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<14} {elapsed:8.1f} s  converted={converted}  output {duration(output):.2f} s,"
+          f" {os.path.getsize(output) / 1024 / 1024:.1f} MiB")
+    return elapsed
+
+
+def main():
+    seconds = int(sys.argv[1] if len(sys.argv) > 1 else 120)
+    workers = int(sys.argv[2] if len(sys.argv) > 2 else os.cpu_count())
+    quality = sys.argv[3] if len(sys.argv) > 3 else "720p"
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(sys.argv) > 4:
+            source = sys.argv[4]
+        else:
+            source = os.path.join(tmp, "sample.mkv")
+            make_sample(source, seconds)
+        print(f"{source}: {duration(source):.2f} s, {quality}, {workers} workers")
+        single = run("single", source, os.path.join(tmp, "single.mp4"), quality, 1)
+        segmented = run("segmented", source, os.path.join(tmp, "segmented.mp4"), quality, workers)
+        print(f"speedup {single / segmented:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Runs ParallelTransferrer uploads with the adaptive controller against a simulated link and
+# prints how the number of active senders and the part size settle over consecutive files.
+#
+#   python benchmarks/sim_adaptive_controller.py [files] [file_mb]
+#
+# The link has a fixed round trip time, a per-connection throughput cap and a total bandwidth
+# shared by all requests in flight, so the best sender count is bandwidth / per-connection cap.
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from FastTelethon import ParallelTransferrer, TransferTuning  # noqa: E402
+
+RTT = 0.03
+CONNECTION_RATE = 4 * 1024 * 1024
+LINK_RATE = 32 * 1024 * 1024
+
+
+class FakeSession:
+    dc_id = 2
+    auth_key = None
+
+
+class FakeSender:
+    def __init__(self):
+        self.in_flight = 0
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self):
+        pass
+
+
+class FakeLink:
+    def __init__(self, loop):
+        self.loop = loop
+        self.session = FakeSession()
+        self.in_flight = 0
+
+    async def _call(self, sender, request):
+        self.in_flight += 1
+        sender.in_flight += 1
+        try:
+            rate = min(CONNECTION_RATE / sender.in_flight, LINK_RATE / self.in_flight)
+            await asyncio.sleep(RTT + len(request.bytes) / rate)
+        finally:
+            self.in_flight -= 1
+            sender.in_flight -= 1
+        return True
+
+
+class SimulatedTransferrer(ParallelTransferrer):
+    async def _create_sender(self):
+        return FakeSender()
+
+
+async def upload(link, tuning, file_size):
+    transferrer = SimulatedTransferrer(link)
+    part_size, part_count, _ = await transferrer.init_upload(1, file_size, tuning=tuning)
+    part = bytes(part_size)
+    start = time.monotonic()
+    for _ in range(part_count):
+        await transferrer.upload(part)
+    await transferrer.finish_upload()
+    return part_size, file_size / (time.monotonic() - start), transferrer.controller.active
+
+
+async def main():
+    files = int(sys.argv[1] if len(sys.argv) > 1 else 8)
+    file_size = int(sys.argv[2] if len(sys.argv) > 2 else 64) * 1024 * 1024
+    print(f"optimum: {LINK_RATE // CONNECTION_RATE} senders,"
+          f" {LINK_RATE / 1024 / 1024:.0f} MiB/s link")
+    with tempfile.TemporaryDirectory() as tmp:
+        tuning = TransferTuning(os.path.join(tmp, "tuning.json"))
+        link = FakeLink(asyncio.get_running_loop())
+        for i in range(files):
+            part_size, goodput, active = await upload(link, tuning, file_size)
+            saved = tuning.get(FakeSession.dc_id)
+            print(f"file {i + 1:>2}: {part_size // 1024:>3} KiB parts, {goodput / 1024 / 1024:5.1f} MiB/s,"
+                  f" {active:>2} senders at the end, next file starts with {saved['connections']:>2} senders"
+                  f" and {saved['part_size_kb']} KiB parts")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())